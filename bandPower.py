@@ -0,0 +1,123 @@
+"""
+Streaming band power calculation.
+Gives the same per-frame band powers as running scipy.signal.stft (with its default
+ hann window, 50% overlap and zero padded boundaries) over the whole signal, then
+ averaging |stft| within each band, but works through fixed-size blocks of frames
+ and only calculates the frequency bins inside the bands. Peak memory therefore
+ doesn't depend on how long the recording is.
+The spectral estimate can be any of spectral.py's backends (default stft), and float32.
+Band averages are taken with a single sparse (bands x bins) matrix, cached per set of
+ bands, sampling rate and segment size, so many bands cost about the same as a few.
+"""
+
+import numpy as np
+import scipy.sparse
+
+import memo
+import profiler
+import spectral
+
+# Samples per STFT segment, as scipy.signal.stft's default.
+NPERSEG = 256
+# Number of STFT frames calculated per block.
+FRAMES_PER_BLOCK = 512
+
+
+# Number of STFT frames for nSamples, as scipy.signal.stft with boundary='zeros', padded=True
+def frameCount(nSamples, nperseg=NPERSEG):
+    step = nperseg - nperseg // 2
+    padded = nSamples + 2 * (nperseg // 2)
+    padded += (-(padded - nperseg) % step) % nperseg
+    return (padded - nperseg) // step + 1
+
+# Frequencies of each STFT bin.
+def binFrequencies(fs, nperseg=NPERSEG):
+    return np.fft.rfftfreq(nperseg, 1. / fs)
+
+# Indexes of the bins strictly inside each band, keyed by band ID.
+def bandBins(bands, fs, nperseg=NPERSEG):
+    freq = binFrequencies(fs, nperseg)
+    return {
+        bandID: np.flatnonzero(np.logical_and(bandHz[0] < freq, freq < bandHz[1]))
+        for bandID, bandHz in bands.items()
+    }
+
+# Hashable form of a {bandID: [lowHz, highHz]} mapping, for caching by.
+def bandKey(bands):
+    return tuple((bandID, tuple(bandHz)) for bandID, bandHz in bands.items())
+
+# Sparse (bands x bins) matrix averaging the bins strictly inside each band, for
+# bandKey(bands). Multiplying a (bins x frames) spectrum by it gives every band's mean at once.
+# Raises ValueError for a band with no bins inside it, e.g. narrower than the bin spacing.
+@memo.memoized
+def bandMatrix(key, fs, nperseg=NPERSEG):
+    binsFor = bandBins(dict(key), fs, nperseg)
+    for bandID, bins in binsFor.items():
+        if len(bins) == 0:
+            raise ValueError("Band %s %s has no frequency bins strictly inside it: bins are %ghz apart, up to %ghz" % (
+                bandID, list(dict(key)[bandID]), float(fs) / nperseg, float(fs) / 2))
+    rows = np.concatenate([np.full(len(bins), i) for i, bins in enumerate(binsFor.values())] + [np.zeros(0, dtype=int)])
+    cols = np.concatenate([bins for bins in binsFor.values()] + [np.zeros(0, dtype=int)])
+    weights = np.concatenate([np.full(len(bins), 1. / len(bins)) for bins in binsFor.values()] + [np.zeros(0)])
+    return scipy.sparse.csr_matrix((weights, (rows, cols)), shape=(len(binsFor), nperseg // 2 + 1))
+
+# Mean over channels and bins in each band, for a (channels x bins x frames) spectrum.
+# Returns band ID -> per-frame powers.
+def bandMeans(powers, bands, fs, nperseg=NPERSEG):
+    means = bandMatrix(bandKey(bands), fs, nperseg) @ np.mean(powers, axis=0)
+    return dict(zip(bands, means))
+
+# Ratios between bands, e.g. {'tbr': ('theta', 'beta')} -> theta / beta, for each frame.
+def bandRatios(bandPowers, ratios):
+    return {ratioID: bandPowers[top] / bandPowers[bottom] for ratioID, (top, bottom) in ratios.items()}
+
+# Read samples [start, end) of the zero-padded signal, where padded sample p is
+# original sample p - offset, and anything outside the original is zero.
+def readPadded(readSamples, nChannels, nSamples, offset, start, end):
+    block = np.zeros((nChannels, end - start))
+    fromSample, toSample = max(start - offset, 0), min(end - offset, nSamples)
+    if fromSample < toSample:
+        block[:, fromSample + offset - start : toSample + offset - start] = readSamples(fromSample, toSample)
+    return block
+
+def bandPowerFrames(readSamples, nChannels, nSamples, fs, bands, frameStart, frameEnd, out, nperseg=NPERSEG,
+        backend='stft', dtype='float64'):
+    """
+    As streamBandPowers, but only for frames [frameStart, frameEnd), written into out[bandID]
+    (arrays over all frames). Blocks start at multiples of FRAMES_PER_BLOCK from frameStart,
+    so frame ranges split on those boundaries give identical results to one full pass.
+    """
+    step, offset = nperseg - nperseg // 2, nperseg // 2
+    matrix = bandMatrix(bandKey(bands), fs, nperseg)
+    # Only the bins some band uses need calculating.
+    allBins = np.unique(matrix.indices)
+    plan = spectral.spectralPlan(backend, fs, nperseg, np.dtype(dtype).name)
+    cosBases, sinBases = spectral.planBases(backend, fs, nperseg, plan.dtype, tuple(int(b) for b in allBins))
+    binWeights = plan.binWeights[allBins]
+    matrix = matrix[:, allBins]
+
+    for blockStart in range(frameStart, frameEnd, FRAMES_PER_BLOCK):
+        blockEnd = min(blockStart + FRAMES_PER_BLOCK, frameEnd)
+        start, end = blockStart * step, (blockEnd - 1) * step + nperseg
+        with profiler.span('read'):
+            block = readPadded(readSamples, nChannels, nSamples, offset, start, end)
+        segments = np.lib.stride_tricks.as_strided(block,
+            shape=(nChannels, blockEnd - blockStart, nperseg),
+            strides=(block.strides[0], block.strides[1] * step, block.strides[1]), writeable=False)
+        with profiler.span('spectra'):
+            powers = spectral.binSpectra(segments, cosBases, sinBases, binWeights, plan)
+        with profiler.span('bandMeans'):
+            means = matrix @ np.mean(powers, axis=0).T
+        for bandID, bandMean in zip(bands, means):
+            out[bandID][blockStart:blockEnd] = bandMean
+
+def streamBandPowers(readSamples, nChannels, nSamples, fs, bands, nperseg=NPERSEG, backend='stft', dtype='float64'):
+    """
+    Mean |stft| (or another spectral backend's estimate) over all channels and all bins within each band, for every frame.
+    readSamples(start, end) returns the (channels x samples) data for that range,
+    so the full signal never needs to be in memory. Returns band ID -> per-frame powers.
+    """
+    nFrames = frameCount(nSamples, nperseg)
+    result = {bandID: np.zeros(nFrames) for bandID in bands}
+    bandPowerFrames(readSamples, nChannels, nSamples, fs, bands, 0, nFrames, result, nperseg, backend, dtype)
+    return result
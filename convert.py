@@ -3,7 +3,18 @@ Bunch of file format conversion utilities.
 """
 
 import csv
+import json
+import os
+import time
+
 import mne.io
+import numpy as np
+
+import loader
+import profiler
+
+# Readings formatted & written at once by edfToCSV
+CSV_BLOCK_SAMPLES = 4096
 
 # Format floats as strings to 6sf. NOTE: maybe not needed?
 def sixSF(readings):
@@ -12,44 +23,72 @@ def sixSF(readings):
 # Given an array of positions (x,y,z), noralize them all to length 1 vectors.
 def normalPos(positions):
     fPos = np.array([[float(p) for p in pos] for pos in positions])
-    return [row / numpy.linalg.norm(row) for row in fPos]
+    return [row / np.linalg.norm(row) for row in fPos]
 
 
 def edfToCSV(edfPath, csvPath):
     """
-    Convert an EDF file to the CSV that openVibe can load as signal
+    Convert an EDF file to the CSV that openVibe can load as signal.
+    Streams through the file CSV_BLOCK_SAMPLES readings at a time, formatting each
+    block with a single string format rather than one format call per value.
     """
-    print "Loading %s..." % edfPath
-    raw = mne.io.read_raw_edf(edfPath, preload=True)
+    print("Loading %s..." % edfPath)
+    with profiler.trial(edfPath):
+        with profiler.span('open'):
+            raw = mne.io.read_raw_edf(edfPath, preload=False)
+        nBytes = writeCSV(raw, csvPath)
+        profiler.note(readings=int(raw.n_times), channels=len(raw.info['ch_names']), bytes=nBytes)
 
-    readings = raw._data.T
+# Write all of raw's readings as CSV (see edfToCSV), a block at a time. Returns the bytes written.
+def writeCSV(raw, csvPath):
+    nReadings = raw.n_times
     channelNames = raw.info['ch_names']
     sampleRate = raw.info['sfreq']
     secPerSample = 1.0 / sampleRate
 
-    print "# Readings: %d" % readings.shape[0]
-    print "# Channels: %d" % len(channelNames)
-    print "Sample rate: %d hz" % sampleRate
+    print("# Readings: %d" % nReadings)
+    print("# Channels: %d" % len(channelNames))
+    print("Sample rate: %d hz" % sampleRate)
 
-    print "Writing to %s..." % csvPath
-    with open(csvPath, 'wb') as csvfile:
+    print("Writing to %s..." % csvPath)
+    startTime, nBytes = time.time(), 0
+    with open(csvPath, 'w', newline='') as csvfile:
         writer = csv.writer(csvfile, delimiter=';')
         writer.writerow(['Time (s)'] + channelNames + ['Sampling Rate'])
-        # First row has extra rate:
-        writer.writerow([0.0] + sixSF(readings[0].tolist()) + [sampleRate])
-        for r in range(1, readings.shape[0]):
-            writer.writerow([r * secPerSample] + sixSF(readings[r].tolist()))
-    print "Done!"
+        for start in range(0, nReadings, CSV_BLOCK_SAMPLES):
+            end = min(start + CSV_BLOCK_SAMPLES, nReadings)
+            with profiler.span('read'):
+                readings = raw.get_data(start=start, stop=end).T
+            with profiler.span('format'):
+                block = csvRows(np.arange(start, end) * secPerSample, readings)
+                if start == 0:
+                    # First row has extra rate:
+                    block = block.replace('\r\n', ';%r\r\n' % float(sampleRate), 1)
+            with profiler.span('write'):
+                csvfile.write(block)
+            nBytes += len(block)
+    elapsed = time.time() - startTime
+    print("Done! %.1f MB in %.1fs, %.1f MB/s" % (nBytes / 1e6, elapsed, nBytes / 1e6 / max(elapsed, 1e-9)))
+    return nBytes
+
+# Format (time, readings) rows as the CSV lines csv.writer would give for
+# [time] + sixSF(readings): time as repr(float), readings to 6dp, ';' separated.
+def csvRows(times, readings):
+    nRows, nChannels = readings.shape
+    values = np.empty((nRows, nChannels + 1))
+    values[:, 0], values[:, 1:] = times, readings
+    rowFormat = '%r' + ';%.6f' * nChannels + '\r\n'
+    return (rowFormat * nRows) % tuple(values.ravel().tolist())
 
 
 def locationsToTxt(inPath, outPath):
     """
     Convert the location data provided for the headset to openvibe sensor location file.
     """
-    print "Loading %s..." % inPath
+    print("Loading %s..." % inPath)
 
     rows = []
-    with open(inPath, 'rb') as inFile:
+    with open(inPath, 'r', newline='') as inFile:
         reader = csv.reader(inFile, delimiter='\t')
         rows = [row for row in reader][3:67]
 
@@ -58,10 +97,57 @@ def locationsToTxt(inPath, outPath):
     header = '[\n\t[ %s ]\n\t[ "x" "y" "z" ]\n]\n' % channelList
     positions = normalPos([row[1:] for row in rows])
 
-    print "Writing %s..." % outPath
+    print("Writing %s..." % outPath)
     with open(outPath, 'w') as outFile:
         outFile.write(header)
         for pos in positions:
             row = "[\n\t[ %s %s %s ]\n]\n" % tuple(pos)
             outFile.write(row)
-    print "Done!"
+    print("Done!")
+
+
+def edfToCache(path, bads=None, chunkSec=60):
+    """
+    Convert an edf in the data folder to the binary cache that loader.py reads instead:
+    all channels as a memory-mappable (channels x samples) float64 .npy, plus a .json
+    sidecar with channel names & types, sample rate, bads, and the edf's content hash.
+    """
+    dataPath, metaPath = loader.cachePaths(path)
+    if not os.path.exists(loader.CACHE_DIR):
+        os.makedirs(loader.CACHE_DIR)
+
+    print("Loading %s..." % path)
+    raw = mne.io.read_raw_edf(loader.DATA_DIR + path, preload=False)
+    sampleRate = raw.info['sfreq']
+    nChannels, nSamples = int(raw.info['nchan']), int(raw.n_times)
+
+    print("Writing to %s..." % dataPath)
+    data = np.lib.format.open_memmap(dataPath + '.tmp.npy', mode='w+', dtype=np.float64, shape=(nChannels, nSamples))
+    chunk = int(chunkSec * sampleRate)
+    for start in range(0, nSamples, chunk):
+        data[:, start:start + chunk] = raw.get_data(start=start, stop=min(start + chunk, nSamples))
+    data.flush()
+    del data
+    os.replace(dataPath + '.tmp.npy', dataPath)
+
+    meta = {
+        'ch_names': raw.info['ch_names'],
+        'ch_types': raw.get_channel_types(),
+        'sfreq': sampleRate,
+        'bads': bads if bads is not None else [],
+        'source': loader.sourceStamp(path),
+    }
+    with open(metaPath, 'w') as f:
+        json.dump(meta, f, indent=1)
+    print("Done!")
+
+def cacheAll(badMapping, force=False):
+    """
+    Convert every edf in a mapping path -> bad channels into the binary cache,
+    skipping those with an up to date cache already unless forced.
+    """
+    for path, bads in sorted(badMapping.items()):
+        if not force and loader.openCached(path) is not None:
+            print("Skipping %s, already cached" % path)
+            continue
+        edfToCache(path, bads)
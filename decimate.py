@@ -0,0 +1,144 @@
+"""
+Optional decimation of trials ahead of analysis, shared by run.py and waveletGenerator.py.
+The recordings are low pass filtered at 30hz, but stored at the acquisition rate, so most
+ of their samples carry nothing above the filter band. Polyphase resampling down to a rate
+ just above it (scipy.signal.resample_poly, with its anti-aliasing FIR filter) keeps that
+ content, while synchronization costs fall with the square of the rate (fewer reference
+ points, each with a shorter window) and band power costs with the rate.
+Resampling can also be streamed a block at a time (see DecimatedReader), giving the same
+ samples as resampling the whole signal at once.
+
+Run directly to compare BSL matrices and TBR curves at the full and decimated rates.
+"""
+
+import argparse
+import fractions
+import time
+
+import numpy as np
+import scipy.signal
+
+# Rate to decimate to: a Nyquist of 64hz is above the 30hz filter band, with room for the
+# resampling filter's transition.
+TARGET_RATE = 128
+# Largest up / down factor used to get near the target rate.
+MAX_FACTOR = 1000
+
+# (up, down) resampling factors taking sRate as near as possible to targetRate.
+def factors(sRate, targetRate):
+    ratio = fractions.Fraction(float(targetRate) / float(sRate)).limit_denominator(MAX_FACTOR)
+    return ratio.numerator, ratio.denominator
+
+# Whether targetRate means decimating a signal at sRate at all.
+def isDecimating(sRate, targetRate):
+    return targetRate is not None and targetRate < sRate
+
+# Sample rate after decimating sRate to targetRate, which may differ slightly from the target.
+def effectiveRate(sRate, targetRate):
+    if not isDecimating(sRate, targetRate):
+        return sRate
+    up, down = factors(sRate, targetRate)
+    return float(sRate) * up / down
+
+# A length of n samples at fullRate, as the nearest whole number of samples (at least 1) at sRate.
+def scaledLength(n, sRate, fullRate):
+    return max(int(round(n * float(sRate) / fullRate)), 1)
+
+# Samples resample_poly gives for nSamples.
+def resampledLength(nSamples, up, down):
+    return -(-nSamples * up // down)
+
+# Input samples either side of an output sample that the resampling filter reaches.
+def filterReach(up, down):
+    return int(np.ceil(10. * max(up, down) / up)) + 1
+
+def resample(data, sRate, targetRate):
+    """
+    A (channels x samples) signal at sRate, resampled to (about) targetRate if that is lower.
+    Returns (data, effective sample rate).
+    """
+    if not isDecimating(sRate, targetRate):
+        return data, sRate
+    up, down = factors(sRate, targetRate)
+    return scipy.signal.resample_poly(data, up, down, axis=-1), effectiveRate(sRate, targetRate)
+
+
+class DecimatedReader(object):
+    '''
+    Wraps readSamples(start, end), reading a signal of nSamples at sRate, to read it resampled
+    to targetRate instead, with the same interface (as bandPower.streamBandPowers takes).
+    Each call only reads what it needs: reads start on a multiple of the down factor, so the
+    output lines up with the whole signal's, plus enough either side for the filter to be exact.
+    If not decimating, reads pass straight through.
+    '''
+    def __init__(self, readSamples, nSamples, sRate, targetRate):
+        self.readSamples = readSamples
+        self.fullSamples = nSamples
+        self.decimating = isDecimating(sRate, targetRate)
+        self.up, self.down = factors(sRate, targetRate) if self.decimating else (1, 1)
+        self.nSamples = resampledLength(nSamples, self.up, self.down)
+        self.sRate = effectiveRate(sRate, targetRate)
+
+    def __call__(self, start, end):
+        if not self.decimating:
+            return self.readSamples(start, end)
+        up, down = self.up, self.down
+        # Output samples [u * up, (u + 1) * up) come from around input samples [u * down, (u + 1) * down)
+        reachUnits = -(-filterReach(up, down) // down)
+        unitStart = max(start // up - reachUnits, 0)
+        unitEnd = -(-end // up) + reachUnits
+        block = self.readSamples(unitStart * down, min(unitEnd * down, self.fullSamples))
+        first = start - unitStart * up
+        return scipy.signal.resample_poly(block, up, down, axis=-1)[:, first:first + end - start]
+
+
+# Compare band powers (as run.py) and BSLs (as waveletGenerator.py) for a recording at its
+# full rate and at targetRate, timing each. Returns a dict of timings and agreement.
+def benchmark(path, bads, targetRate=TARGET_RATE, nProcesses=None):
+    import loader
+    import pairScheduler
+    import run
+    import waveletGenerator
+
+    report = {}
+    raw = loader.openRaw(path, bads, run.START_TIME_SEC, run.END_TIME_SEC, verbose=False)
+    tbrs, times = {}, {}
+    for rate in [None, targetRate]:
+        run.DECIMATE_TO_HZ = rate
+        start = time.time()
+        tbrs[rate] = np.log(run.calcBandPowersStreaming(raw)['tbr'])
+        report['band powers sec @ %s' % (rate or 'full')] = time.time() - start
+        # Frames are about as long in seconds at either rate, but not exactly: compare over time.
+        _, nperseg = run.trialReader(raw, None)
+        sRate = effectiveRate(raw.info['sfreq'], rate)
+        times[rate] = np.arange(len(tbrs[rate])) * (nperseg - nperseg // 2) / sRate
+    run.DECIMATE_TO_HZ = None
+    full = tbrs[None]
+    decimated = np.interp(times[None], times[targetRate], tbrs[targetRate])
+    inBoth = times[None] <= times[targetRate][-1]
+    report['log tbr correlation'] = np.corrcoef(full[inBoth], decimated[inBoth])[0, 1]
+    report['log tbr max abs difference'] = np.abs(full[inBoth] - decimated[inBoth]).max()
+
+    data, channels, fullRate = waveletGenerator.loadSignal(path, bads)
+    bsls = {}
+    for rate in [None, targetRate]:
+        signal, sRate = resample(data, fullRate, rate)
+        params = waveletGenerator.trialParams(sRate, fullRate)
+        start = time.time()
+        bsls[rate] = pairScheduler.parallelBSLs(signal, params, nProcesses)
+        report['BSLs sec @ %s (%.1fhz, %s)' % (rate or 'full', sRate, tuple(params))] = time.time() - start
+    offDiagonal = ~np.eye(len(channels), dtype=bool)
+    report['BSL correlation (off diagonal)'] = np.corrcoef(bsls[None][offDiagonal], bsls[targetRate][offDiagonal])[0, 1]
+    report['BSL max abs difference'] = np.abs(bsls[None] - bsls[targetRate]).max()
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help="EDF to benchmark on, within data/")
+    parser.add_argument('--bads', nargs='*', default=['STI 014', 'EEG VREF'], help="Bad channels to leave out")
+    parser.add_argument('--rate', type=float, default=TARGET_RATE, help="Rate to decimate to")
+    parser.add_argument('--processes', type=int, default=None, help="Worker processes for the BSLs")
+    args = parser.parse_args()
+
+    for name, value in benchmark(args.path, args.bads, args.rate, args.processes).items():
+        print("%-60s %s" % (name, value))
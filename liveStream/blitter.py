@@ -0,0 +1,42 @@
+# Redraws only the changing parts of live graphs, using blitting.
+
+class Blitter:
+    """
+    Renders a figure of live panels (e.g. LiveGraph, LiveHist created with blit=True).
+    The static parts of each panel's axes are drawn once and cached; each render then
+    restores that background and redraws just the panel's artists. Panels needing a
+    full redraw (e.g. a title or axis change) trigger one, and the backgrounds are recached.
+    """
+    def __init__(self, fig, panels):
+        self.fig = fig
+        self.canvas = fig.canvas
+        self.panels = panels
+        self.backgrounds = None
+        self.fullDraws = 0
+        self.canvas.mpl_connect('draw_event', self.onDraw)
+
+    def onDraw(self, event):
+        """
+        Figure was fully drawn (by us, or e.g. a resize): recache backgrounds and draw artists on top.
+        """
+        self.backgrounds = [self.canvas.copy_from_bbox(panel.ax.bbox) for panel in self.panels]
+        for panel in self.panels:
+            for artist in panel.artists():
+                panel.ax.draw_artist(artist)
+
+    def render(self):
+        """
+        Update all panels, then draw whatever changed.
+        """
+        needsFullDraw = [panel.update() for panel in self.panels]
+        if self.backgrounds is None or any(needsFullDraw):
+            self.fullDraws += 1
+            self.canvas.draw()
+            self.canvas.blit(self.fig.bbox)
+        else:
+            for panel, background in zip(self.panels, self.backgrounds):
+                self.canvas.restore_region(background)
+                for artist in panel.artists():
+                    panel.ax.draw_artist(artist)
+                self.canvas.blit(panel.ax.bbox)
+        self.canvas.flush_events()
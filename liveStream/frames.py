@@ -0,0 +1,108 @@
+# Pairs up values arriving as separate OSC messages (e.g. is_good, theta, beta) into frames.
+
+from collections import deque
+
+# Arrivals per stream that the frame period is measured over.
+PERIOD_MESSAGES = 64
+# Arrivals needed on a stream before its measured period is trusted over the expected one.
+MIN_PERIOD_MESSAGES = 2
+# Messages further apart than this fraction of the frame period aren't paired.
+TOLERANCE_FRACTION = 0.5
+
+class FrameAssembler:
+    """
+    Keeps a bounded queue of (time, values) per stream, and emits a frame from each stream's
+    oldest queued message once they're the nearest in time to each other, and within the tolerance:
+    half the frame period. The period starts as the one expected, then is measured from how often
+    each stream's messages arrive, so the pairing follows whatever rate frames are sent at.
+    Frames go to onFrame(time, {stream: values}) in order, time being the latest arrival.
+
+    If a message is lost, the other streams' messages for its frame are left at the heads of their
+    queues. They're recognized by the same stream's next message being nearer in time to the
+    newest head than they are, and discarded, so one loss costs one frame rather than shifting
+    every later pairing by a frame.
+
+    Messages are discarded, and counted, when they can no longer be part of a frame:
+      partial - no message from some other stream arrived near enough in time to it.
+      dropped - the stream's queue was full (maxQueue) so the oldest was pushed out.
+      late    - arrived timestamped before the last emitted frame.
+    """
+    def __init__(self, streams, onFrame, period=0.1, maxQueue=16):
+        self.streams = list(streams)
+        self.onFrame = onFrame
+        self.expectedPeriod = period
+        self.maxQueue = maxQueue
+        self.queues = {stream: deque() for stream in self.streams}
+        self.arrivals = {stream: deque(maxlen=PERIOD_MESSAGES) for stream in self.streams}
+        self.tolerance = TOLERANCE_FRACTION * period
+        self.lastFrameTime = float('-inf')
+        self.frames, self.partial, self.dropped, self.late = 0, 0, 0, 0
+
+    def period(self):
+        """
+        Seconds between frames: the median over streams of their average gap between arrivals,
+        or the expected period until enough have arrived.
+        """
+        gaps = sorted((arrivals[-1] - arrivals[0]) / (len(arrivals) - 1)
+                      for arrivals in self.arrivals.values() if len(arrivals) >= MIN_PERIOD_MESSAGES)
+        return gaps[len(gaps) // 2] if gaps else self.expectedPeriod
+
+    def push(self, stream, time, values):
+        """
+        Add the values for one stream, received at the given time, emitting any frames now complete.
+        Times are expected to be (mostly) increasing, e.g. arrival times.
+        """
+        self.arrivals[stream].append(time)
+        if time < self.lastFrameTime:
+            self.late += 1
+            return
+        queue = self.queues[stream]
+        if len(queue) == self.maxQueue:
+            queue.popleft()
+            self.dropped += 1
+        queue.append((time, values))
+        self.tolerance = TOLERANCE_FRACTION * self.period()
+        self.assemble(time)
+
+    # Discard the head of a stream's queue that won't be part of a frame.
+    def discardHead(self, stream):
+        self.queues[stream].popleft()
+        self.partial += 1
+
+    def assemble(self, now):
+        """
+        Emit frames while every stream has a message queued, discarding unmatched ones.
+        """
+        while all(self.queues.values()):
+            times = [self.queues[stream][0][0] for stream in self.streams]
+            newest = max(times)
+            # A head whose stream has a later message nearer the newest head belongs to an earlier,
+            # incomplete frame.
+            stale = [stream for stream, time in zip(self.streams, times)
+                     if len(self.queues[stream]) > 1 and abs(self.queues[stream][1][0] - newest) < newest - time]
+            if stale:
+                for stream in stale:
+                    self.discardHead(stream)
+                continue
+            oldest = min(range(len(times)), key=times.__getitem__)
+            if newest - times[oldest] > self.tolerance:
+                # Nothing from some stream arrived close enough to the oldest, so it'll never be paired.
+                self.discardHead(self.streams[oldest])
+                continue
+            heads = [self.queues[stream].popleft() for stream in self.streams]
+            self.lastFrameTime = newest
+            self.frames += 1
+            self.onFrame(self.lastFrameTime, {stream: head[1] for stream, head in zip(self.streams, heads)})
+
+        # Anything older than tolerance can't pair with a stream still waiting on its next message.
+        for stream, queue in self.queues.items():
+            while queue and queue[0][0] < now - self.tolerance:
+                self.discardHead(stream)
+
+    def stats(self):
+        """
+        Counts of frames emitted, and messages discarded as partial, dropped or late, with the
+        measured frame period.
+        """
+        return {'frames': self.frames, 'partial': self.partial, 'dropped': self.dropped, 'late': self.late,
+                'period': self.period()}
@@ -3,40 +3,65 @@
 
 import matplotlib.pyplot as plt
 import numpy as np
-from collections import deque
 
 # Scrolling graph of values, with additional connected status
 class LiveGraph:
-    def __init__(self, ax, title, maxEntries = 100, minY = -2.0, maxY = 2.0):
+    def __init__(self, ax, title, maxEntries = 100, minY = -2.0, maxY = 2.0, blit = False):
         self.ax = ax
         self.isGood = False
-        self.yValues = deque(maxlen = maxEntries)
+        self.shownGood = True # Status the title currently shows
         self.title = title
 
-        # Set up graph
-        self.lineplot, = ax.plot([], [], "b+-")
+        # Preallocated ring of the last maxEntries values, count = total ever added.
+        self.maxEntries = maxEntries
+        self.yValues = np.zeros(maxEntries)
+        self.count = 0
+        self.xValues = np.arange(maxEntries)
+        self.changed = False
+        self.needsFullDraw = False
+
+        # Set up graph. When blitting, the line is drawn separately to the static background.
+        self.lineplot, = ax.plot([], [], "b+-", animated = blit)
         self.ax.set_title(self.title)
         self.ax.set_xlim(0, maxEntries - 1 + 1e-9)
         self.ax.set_ylim(minY, maxY)
 
     def setGood(self, isGood):
         """
-        Update the 'good' status of the graph, changing visual appearance too
+        Update the 'good' status of the graph, changing visual appearance only if it changed
         """
         self.isGood = isGood
+        if self.isGood == self.shownGood:
+            return
+        self.shownGood = self.isGood
         if self.isGood:
             self.ax.set_title(self.title)
             self.ax.title.set_color('black')
         else:
             self.ax.set_title(self.title + ' ** dc')
             self.ax.title.set_color('red')
+        self.needsFullDraw = True
 
     def add(self, y):
         """
-        Adds the most recent y value onto the graph, and scrolls it into view.
+        Adds the most recent y value onto the graph, to be scrolled into view on the next update.
         """
-        if self.isGood:
-            self.yValues.append(y)
-        else:
-            self.yValues.append(0.)
-        self.lineplot.set_data(np.arange(0, len(self.yValues)), self.yValues)
+        self.yValues[self.count % self.maxEntries] = y if self.isGood else 0.
+        self.count += 1
+        self.changed = True
+
+    def update(self):
+        """
+        Push added values to the line. Returns whether the whole figure needs redrawing,
+        rather than just the artists.
+        """
+        if self.changed:
+            n = min(self.count, self.maxEntries)
+            oldest = self.count % self.maxEntries if self.count > self.maxEntries else 0
+            self.lineplot.set_data(self.xValues[:n], np.roll(self.yValues, -oldest)[:n])
+            self.changed = False
+        needsFullDraw, self.needsFullDraw = self.needsFullDraw, False
+        return needsFullDraw
+
+    def artists(self):
+        return [self.lineplot]
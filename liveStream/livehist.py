@@ -1,41 +1,66 @@
 # Draws histogram of all tbr, rather than graph of last N
 
+import time
+
 import matplotlib.pyplot as plt
 import numpy as np
-from collections import deque
 
-# Scrolling graph of values, with additional connected status
+import livestats
+
+# Minimum time between rescaling the y-axis, or moving the x range, in seconds.
+RESCALE_SEC = 1.0
+# With an adaptive range, the x-axis covers these quantiles of values seen, plus a margin either side.
+RANGE_QUANTILES = (0.01, 0.99)
+RANGE_MARGIN = 0.1
+# Values needed before the range starts adapting.
+MIN_ADAPT_VALUES = 20
+
+# Histogram of all values, with additional connected status.
+# Running statistics of the values are kept in stats (see livestats.py). If adaptive, the
+# x range follows where most values lie rather than staying at [minX, maxX], and
+# the histogram is drawn from the stats' quantile sketch instead of fixed buckets.
 class LiveHist:
-    def __init__(self, ax, title, segments = 20, minX = -2.0, maxX = 2.0):
+    def __init__(self, ax, title, segments = 20, minX = -2.0, maxX = 2.0, blit = False,
+                 adaptive = False, halfLife = None):
         self.ax = ax
         self.title = title
         self.segments = segments
         self.minX = minX
         self.maxX = maxX
+        self.adaptive = adaptive
+        self.stats = livestats.ChannelStats(halfLife)
         self.isGood = False
+        self.shownGood = True # Status the title currently shows
+        self.changed = False
+        self.needsFullDraw = False
+        self.lastRescale = 0.
 
         # Precalculate bucket positions and initialize counts to empty.
         segWidth = (maxX - minX) / segments
         self.xs = minX + (np.arange(0, segments) + 0.5) * segWidth
         self.counts = np.zeros(segments)
 
-        # Set up graph
-        self.lineplot, = ax.plot(self.xs, self.counts, "b+-")
+        # Set up graph. When blitting, the line is drawn separately to the static background.
+        self.lineplot, = ax.plot(self.xs, self.counts, "b+-", animated = blit)
         self.ax.set_title(self.title)
         self.ax.set_xlim(minX, maxX)
-        self.ax.set_autoscaley_on(True)
+        self.ax.set_ylim(0, 1)
 
     def setGood(self, isGood):
         """
-        Update the 'good' status of the graph, changing visual appearance too
+        Update the 'good' status of the graph, changing visual appearance only if it changed
         """
         self.isGood = isGood
+        if self.isGood == self.shownGood:
+            return
+        self.shownGood = self.isGood
         if self.isGood:
             self.ax.set_title(self.title)
             self.ax.title.set_color('black')
         else:
             self.ax.set_title(self.title + ' ** dc')
             self.ax.title.set_color('red')
+        self.needsFullDraw = True
 
     def add(self, value):
         """
@@ -43,6 +68,10 @@ class LiveHist:
         """
         if not self.isGood:
             return
+        self.stats.add(value)
+        self.changed = True
+        if self.adaptive:
+            return
 
         # Convert value to bucket it lies in.
         if value < self.minX:
@@ -53,6 +82,49 @@ class LiveHist:
             bucket = int(self.segments * (value - self.minX) / (self.maxX - self.minX))
         self.counts[bucket] += 1
 
-        self.lineplot.set_data(self.xs, self.counts)
-        self.ax.relim()
-        self.ax.autoscale_view() # rescale the y-axis
+    def adaptRange(self):
+        """
+        Move the x range to cover most values seen, if it's drifted far enough from that.
+        Returns whether it moved.
+        """
+        sketch = self.stats.sketch
+        if sketch.count() < MIN_ADAPT_VALUES:
+            return False
+        lo, hi = sketch.quantile(RANGE_QUANTILES)
+        margin = max(hi - lo, 1e-6) * RANGE_MARGIN
+        lo, hi = lo - margin, hi + margin
+        width = self.maxX - self.minX
+        if lo >= self.minX and hi <= self.maxX and hi - lo > width / 2:
+            return False
+        self.minX, self.maxX = lo, hi
+        self.xs = lo + (np.arange(0, self.segments) + 0.5) * (hi - lo) / self.segments
+        self.lineplot.set_xdata(self.xs)
+        self.ax.set_xlim(lo, hi)
+        self.needsFullDraw = True
+        return True
+
+    def update(self):
+        """
+        Push new counts to the line, rescaling the y-axis (and x range, if adaptive) at most every
+        RESCALE_SEC. Returns whether the whole figure needs redrawing, rather than just the artists.
+        """
+        if self.changed:
+            now = time.time()
+            rescale = now - self.lastRescale > RESCALE_SEC
+            if self.adaptive:
+                if rescale and self.adaptRange():
+                    self.lastRescale = now
+                edges = np.linspace(self.minX, self.maxX, self.segments + 1)
+                self.counts = np.diff(self.stats.sketch.cdf(edges)) * self.stats.sketch.count()
+            self.lineplot.set_ydata(self.counts)
+            self.changed = False
+            top = self.ax.get_ylim()[1]
+            if self.counts.max() > top and rescale:
+                self.ax.set_ylim(0, self.counts.max() * 1.5)
+                self.lastRescale = now
+                self.needsFullDraw = True
+        needsFullDraw, self.needsFullDraw = self.needsFullDraw, False
+        return needsFullDraw
+
+    def artists(self):
+        return [self.lineplot]
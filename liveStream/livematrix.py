@@ -0,0 +1,51 @@
+# Draws a matrix of values between channels, e.g. live synchronization (see livesync.py)
+
+import numpy as np
+
+# Colour-coded (channels x channels) matrix, redrawn whenever a new one is set.
+class LiveMatrix:
+    def __init__(self, ax, title, labels, minV = 0.0, maxV = 1.0, blit = False):
+        self.ax = ax
+        self.title = title
+        self.matrix = np.zeros((len(labels), len(labels)))
+        self.changed = False
+        self.needsFullDraw = False
+
+        # Set up graph. When blitting, the image is drawn separately to the static background.
+        self.image = ax.imshow(self.matrix, vmin = minV, vmax = maxV, cmap = 'viridis',
+                               interpolation = 'nearest', animated = blit)
+        self.ax.set_title(self.title)
+        self.ax.set_xticks(np.arange(len(labels)))
+        self.ax.set_yticks(np.arange(len(labels)))
+        self.ax.set_xticklabels(labels, rotation = 45, ha = 'right')
+        self.ax.set_yticklabels(labels)
+        ax.figure.colorbar(self.image, ax = ax)
+
+    def set(self, matrix):
+        """
+        Show a new matrix on the next update.
+        """
+        self.matrix = matrix
+        self.changed = True
+
+    def setTitle(self, title):
+        """
+        Change the title, e.g. to show status, which needs a full redraw.
+        """
+        if title != self.ax.get_title():
+            self.ax.set_title(title)
+            self.needsFullDraw = True
+
+    def update(self):
+        """
+        Push the latest matrix to the image. Returns whether the whole figure needs redrawing,
+        rather than just the artists.
+        """
+        if self.changed:
+            self.image.set_data(self.matrix)
+            self.changed = False
+        needsFullDraw, self.needsFullDraw = self.needsFullDraw, False
+        return needsFullDraw
+
+    def artists(self):
+        return [self.image]
@@ -0,0 +1,236 @@
+# Running statistics for live values (e.g. log TBR), in bounded memory however long the session.
+# Everything here can be merged, e.g. across channels, or with a baseline from a previous session.
+
+import json
+import math
+
+import numpy as np
+
+# Mean and variance, updated one value at a time (Welford's algorithm).
+class Moments:
+    def __init__(self, n=0, mean=0.0, m2=0.0):
+        self.n = n
+        self.mean = mean
+        self.m2 = m2 # Sum of squared differences from the mean
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    def merge(self, other):
+        """
+        Combine with moments from other values, as if they'd all been added here.
+        """
+        n = self.n + other.n
+        if n == 0:
+            return self
+        delta = other.mean - self.mean
+        self.mean += delta * other.n / n
+        self.m2 += other.m2 + delta * delta * self.n * other.n / n
+        self.n = n
+        return self
+
+    def variance(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else float('nan')
+
+    def std(self):
+        return math.sqrt(self.variance())
+
+    def toDict(self):
+        return {'n': self.n, 'mean': self.mean, 'm2': self.m2}
+
+
+# Mean and variance with older values weighted down, halving every halfLife values added.
+class DecayedMoments:
+    def __init__(self, halfLife, weight=0.0, mean=0.0, s=0.0):
+        self.halfLife = halfLife
+        self.alpha = 0.5 ** (1.0 / halfLife)
+        self.weight = weight # Total (decayed) weight of values added
+        self.mean = mean
+        self.s = s # Weighted sum of squared differences from the mean
+
+    def add(self, x):
+        self.weight = self.weight * self.alpha + 1
+        delta = x - self.mean
+        self.mean += delta / self.weight
+        self.s = self.s * self.alpha + delta * (x - self.mean)
+
+    def merge(self, other):
+        """
+        Combine with other decayed moments, assumed to be decayed up to the same point in time.
+        """
+        weight = self.weight + other.weight
+        if weight == 0:
+            return self
+        delta = other.mean - self.mean
+        self.mean += delta * other.weight / weight
+        self.s += other.s + delta * delta * self.weight * other.weight / weight
+        self.weight = weight
+        return self
+
+    def variance(self):
+        return self.s / self.weight if self.weight > 0 else float('nan')
+
+    def std(self):
+        return math.sqrt(self.variance())
+
+    def toDict(self):
+        return {'halfLife': self.halfLife, 'weight': self.weight, 'mean': self.mean, 's': self.s}
+
+
+# Approximate quantiles in bounded memory, similar to a merging t-digest.
+class QuantileSketch:
+    """
+    Values are summarised as weighted centroids, kept small near the tails and larger
+    in the middle, so extreme quantiles stay accurate. At most about compression / 2
+    centroids are kept, plus a buffer of new values merged in when it fills.
+    """
+    def __init__(self, compression=200, bufferSize=None):
+        self.compression = compression
+        self.bufferSize = bufferSize or 5 * compression
+        self.means = np.zeros(0)
+        self.weights = np.zeros(0)
+        self.buffer = []
+        self.min, self.max = float('inf'), float('-inf')
+
+    def add(self, x):
+        self.buffer.append(x)
+        if x < self.min:
+            self.min = x
+        if x > self.max:
+            self.max = x
+        if len(self.buffer) >= self.bufferSize:
+            self.flush()
+
+    def count(self):
+        return self.weights.sum() + len(self.buffer)
+
+    def flush(self):
+        """
+        Merge buffered values into the centroids.
+        """
+        if self.buffer:
+            self.compress(np.concatenate((self.means, self.buffer)),
+                          np.concatenate((self.weights, np.ones(len(self.buffer)))))
+            self.buffer = []
+
+    def compress(self, means, weights):
+        # Group neighbouring centroids by where their middle falls on the arcsine scale,
+        # which gives ~compression / 2 groups, narrowest at the tails.
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+        total = weights.sum()
+        q = (np.cumsum(weights) - weights / 2) / total
+        k = self.compression / (2 * np.pi) * np.arcsin(2 * q - 1)
+        groups = np.floor(k - k[0]).astype(int)
+        groupWeights = np.bincount(groups, weights)
+        keep = groupWeights > 0
+        self.weights = groupWeights[keep]
+        self.means = np.bincount(groups, weights * means)[keep] / self.weights
+
+    def merge(self, other):
+        """
+        Combine with another sketch, as if its values had been added here.
+        """
+        self.flush()
+        other.flush()
+        if len(other.means):
+            self.compress(np.concatenate((self.means, other.means)),
+                          np.concatenate((self.weights, other.weights)))
+        self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+        return self
+
+    def points(self):
+        # Cumulative weight at each centroid's middle, with the exact min and max at either end.
+        self.flush()
+        positions = np.cumsum(self.weights) - self.weights / 2
+        return (np.concatenate(([0], positions, [self.weights.sum()])),
+                np.concatenate(([self.min], self.means, [self.max])))
+
+    def quantile(self, q):
+        """
+        Approximate value(s) below which fraction q of values lie.
+        """
+        if self.count() == 0:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else float('nan')
+        positions, values = self.points()
+        return np.interp(np.asarray(q) * positions[-1], positions, values)
+
+    def cdf(self, x):
+        """
+        Approximate fraction of values below x, for one or more x.
+        """
+        if self.count() == 0:
+            return np.zeros(np.shape(x)) if np.ndim(x) else 0.0
+        positions, values = self.points()
+        return np.interp(x, values, positions, left=0, right=positions[-1]) / positions[-1]
+
+    def toDict(self):
+        self.flush()
+        return {'compression': self.compression, 'min': self.min, 'max': self.max,
+                'means': self.means.tolist(), 'weights': self.weights.tolist()}
+
+
+# All the running statistics kept for one channel.
+class ChannelStats:
+    def __init__(self, halfLife=None, compression=200):
+        self.moments = Moments()
+        self.decayed = DecayedMoments(halfLife) if halfLife else None
+        self.sketch = QuantileSketch(compression)
+
+    def add(self, x):
+        self.moments.add(x)
+        if self.decayed is not None:
+            self.decayed.add(x)
+        self.sketch.add(x)
+
+    def merge(self, other):
+        self.moments.merge(other.moments)
+        if self.decayed is not None and other.decayed is not None:
+            self.decayed.merge(other.decayed)
+        self.sketch.merge(other.sketch)
+        return self
+
+    def summary(self):
+        """
+        Count, mean, standard deviation and quartiles, plus decayed mean and deviation if kept.
+        """
+        q1, median, q3 = self.sketch.quantile([0.25, 0.5, 0.75])
+        result = {'n': self.moments.n, 'mean': self.moments.mean, 'std': self.moments.std(),
+                  'q1': q1, 'median': median, 'q3': q3}
+        if self.decayed is not None:
+            result['recentMean'] = self.decayed.mean
+            result['recentStd'] = self.decayed.std()
+        return result
+
+    def toDict(self):
+        result = {'moments': self.moments.toDict(), 'sketch': self.sketch.toDict()}
+        if self.decayed is not None:
+            result['decayed'] = self.decayed.toDict()
+        return result
+
+    @staticmethod
+    def fromDict(d):
+        stats = ChannelStats(d['decayed']['halfLife'] if 'decayed' in d else None, d['sketch']['compression'])
+        stats.moments = Moments(**d['moments'])
+        if 'decayed' in d:
+            stats.decayed = DecayedMoments(**d['decayed'])
+        stats.sketch.min, stats.sketch.max = d['sketch']['min'], d['sketch']['max']
+        stats.sketch.means = np.array(d['sketch']['means'])
+        stats.sketch.weights = np.array(d['sketch']['weights'])
+        return stats
+
+# Save per-channel stats, as {name: {channel: ChannelStats}}, to a JSON file.
+def saveBaselines(path, baselines):
+    with open(path, 'w') as f:
+        json.dump({name: {str(channel): stats.toDict() for channel, stats in channels.items()}
+                   for name, channels in baselines.items()}, f)
+
+# Load stats saved by saveBaselines.
+def loadBaselines(path):
+    with open(path) as f:
+        saved = json.load(f)
+    return {name: {int(channel): ChannelStats.fromDict(d) for channel, d in channels.items()}
+            for name, channels in saved.items()}
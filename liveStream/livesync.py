@@ -0,0 +1,131 @@
+# Live bivariate synchronization (BS) between the Muse's 4 channels, from the raw /muse/eeg stream.
+# Uses the same definitions as the offline analysis (synchro.py, slidingSync.py in the parent
+# directory): the same delay embedding, epsilons and neighbour bitsets, with reference points
+# every Q samples from the first sample received, so the numbers match an offline run over the
+# same samples. Only the reference points in the last windowSec are averaged over.
+# Work per update is limited to a time budget, so it keeps up with 256hz rather than falling
+# behind: if the backlog grows past MAX_BACKLOG_SEC anyway, the oldest reference points are skipped.
+# Doesn't need matplotlib, see syncplot.py for the display.
+# synchro and slidingSync are imported from the repository root, which has to be on the path
+# along with this directory: run from liveStream/ as `PYTHONPATH=.. python3 syncplot.py`.
+
+import time
+
+import numpy as np
+
+import slidingSync
+import synchro
+
+import receiver
+
+# Sample rate of the Muse's raw EEG.
+MUSE_RAW_RATE = 256
+# Embedding and window parameters, as in waveletGenerator.py: W2 is half a second.
+PARAM_d = 10
+PARAM_T = 1
+P_REF = 0.05
+W1 = (PARAM_d - 1) * PARAM_T
+# Samples between reference points, 1/16 of a second at 256hz.
+Q = 16
+# Seconds of reference points the live matrix is averaged over.
+WINDOW_SEC = 4
+# Seconds of processing allowed per update.
+BUDGET_SEC = 0.02
+# Reference points processed together, between checks of the budget.
+REF_BLOCK = 8
+# Pending reference points older than this many seconds are skipped rather than caught up on.
+MAX_BACKLOG_SEC = 2
+
+# Parameters for a given raw sample rate, matching the offline Trial's.
+def liveParams(sRate=MUSE_RAW_RATE):
+    return synchro.SyncParams(PARAM_d, PARAM_T, W1, int(sRate // 2), P_REF, Q)
+
+class LiveSync:
+    """
+    Rolling BS(k, r) for all channel pairs of one session's raw samples (see receiver.Session, raw=True).
+    Call update() regularly to take in new samples and process what the budget allows, then
+    bsls() for the current matrix. Samples dropped by the ring buffer restart the window.
+    """
+    def __init__(self, session, sRate=MUSE_RAW_RATE, params=None, windowSec=WINDOW_SEC,
+                 budgetSec=BUDGET_SEC, maxBacklogSec=MAX_BACKLOG_SEC):
+        self.session = session
+        self.params = params or liveParams(sRate)
+        self.budgetSec = budgetSec
+        self.maxBacklogRefs = max(int(maxBacklogSec * sRate / self.params.Q), REF_BLOCK)
+        self.windowRefs = max(int(round(windowSec * sRate / self.params.Q)), 1)
+        self.offsets = synchro.windowOffsets(self.params.W1, self.params.W2)
+        self.scale = synchro.syncScale(self.params)
+        self.cursor = 0
+        self.processed = 0 # Reference points counted
+        self.skipped = 0 # Reference points skipped to keep up
+        self.restarts = 0 # Times samples were dropped, restarting the window
+        self.restart()
+
+    def restart(self):
+        """
+        Forget all samples and counts, starting again from the next sample received.
+        """
+        self.samples = np.zeros((receiver.N_CHANNELS, 0))
+        self.start = 0 # Sample number of samples[:, 0]
+        self.count = 0 # Samples received since the restart
+        self.nextRef = self.params.W2
+        self.sliding = slidingSync.SlidingPairCounts(receiver.N_CHANNELS, self.windowRefs)
+
+    # Reference points whose whole window has arrived, from nextRef on (as synchro.referencePoints)
+    def readyRefs(self):
+        nVectors = self.count - (self.params.d - 1) * self.params.T
+        return np.arange(self.nextRef, min(self.count - self.params.W2 - 1, nVectors - self.params.W2 + 1), self.params.Q)
+
+    def receive(self):
+        rows, dropped, self.cursor = self.session.rawSamples.readSince(self.cursor)
+        if dropped:
+            self.restarts += 1
+            self.restart()
+        if len(rows):
+            self.samples = np.concatenate((self.samples, rows[:, 1:].T), axis=1)
+            self.count += len(rows)
+
+    def update(self):
+        """
+        Take in new samples and count pairs for as many ready reference points as the budget allows.
+        Returns the number of reference points processed.
+        """
+        deadline = time.time() + self.budgetSec
+        self.receive()
+        refs = self.readyRefs()
+        if len(refs) > self.maxBacklogRefs:
+            skip = len(refs) - self.maxBacklogRefs
+            self.skipped += skip
+            refs = refs[skip:]
+        done = 0
+        if len(refs):
+            embedded = synchro.embed(self.samples, self.params.d, self.params.T)
+        while done < len(refs) and (done == 0 or time.time() < deadline):
+            ns = refs[done:done + REF_BLOCK]
+            bits = slidingSync.blockNeighbours(embedded, ns - self.start, self.offsets, self.params.pRef)
+            for i in range(bits.shape[1]):
+                self.sliding.add(slidingSync.pointPairCounts(bits[:, i]))
+            done += len(ns)
+        self.processed += done
+        if done:
+            self.nextRef = refs[done - 1] + self.params.Q
+        # Keep only the samples still needed for the next reference point's window.
+        unneeded = max(self.nextRef - (self.params.W2 - 1) - self.start, 0)
+        if unneeded:
+            self.samples = self.samples[:, unneeded:]
+            self.start += unneeded
+        return done
+
+    def pending(self):
+        """
+        Reference points ready but not yet processed.
+        """
+        return len(self.readyRefs())
+
+    def bsls(self):
+        """
+        BS(k, r) for all channel pairs over the reference points in the window, or None if there are none yet.
+        """
+        if not self.sliding.window:
+            return None
+        return self.sliding.bsls(self.scale)
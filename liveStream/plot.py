@@ -2,15 +2,17 @@ import argparse
 import math
 import matplotlib.pyplot as plt
 import numpy as np
+import os
+import time
 
-# pip3 install python-osc
-from pythonosc import dispatcher
-from pythonosc import osc_server
-# See here for example:
+# OSC is received in receiver.py, see here for example:
 # http://developer.choosemuse.com/research-tools-example/grabbing-data-from-museio-a-few-simple-examples-of-muse-osc-servers#python
 
+import blitter
 import livegraph
 import livehist
+import livestats
+import receiver
 
 # Utility to make all the subplots we need.
 def cleanSubplots(r=2, c=4, pad=0.05):
@@ -25,45 +27,82 @@ def cleanSubplots(r=2, c=4, pad=0.05):
         axes.append(row)
     return axes
 
+# Frames drawn per second. Whatever arrives between frames is drawn together.
+RENDER_FPS = 20
+# How often to print the received / dropped / rendered counters, in seconds.
+STATS_SEC = 5
+# Whether to redraw only the changing lines (see blitter.py), rather than the full figure.
+BLIT = True
+# Whether histograms follow the range of values seen, rather than a fixed -2 to 2.
+ADAPTIVE_RANGE = True
+# Recent TBR stats (see livestats.py) weight values down by half every this many frames, ~1 minute.
+RECENT_HALF_LIFE = 600
+
+# Per device, a 2x4 grid of graphs: plots[device][row][column]
 plots = []
-lastG = None
-lastB = None
-lastT = None
 
-# Process the latest batch of isGood, theta, beta for each channel.
-def process(g, t, b):
+# The histogram (which holds the running stats) for channel i of a device.
+def channelHist(devicePlots, i):
+    return devicePlots[i // 2][2 * (i % 2) + 1]
+
+# Process the latest isGood and log theta/beta ratio for each channel of one device.
+def process(devicePlots, g, logTBR):
     for i in range(4):
         r = i // 2
         for c in range(2 * (i % 2), 2 * (i % 2 + 1)): # two graphs per channel
-            plots[r][c].setGood(g[i] == 1)
-            plots[r][c].add(np.log(t[i]/b[i])) # Use log ratio for now
-    plt.pause(0.001)
-
-# Process the status only once all the values are available
-def tryProcess():
-    global lastG, lastB, lastT
-    if lastG is None or lastB is None or lastT is None:
-        return
-    process(lastG, lastB, lastT)
-    lastG, lastB, lastT = None, None, None # Clear status, ready for next ones.
+            devicePlots[r][c].setGood(g[i] == 1)
+            devicePlots[r][c].add(logTBR[i])
 
-# isGood returned, process if it's the last to show up
-def gHandler(unused_addr, ch1, ch2, ch3, ch4):
-    global lastG
-    lastG = [ch1, ch2, ch3, ch4]
-    tryProcess()
+# Read the frames each session received since its cursor, stacked together.
+# Returns (frames, which session each came from, dropped per session)
+def readSessions(sessions, cursors):
+    batches, dropped = [], []
+    for d, session in enumerate(sessions):
+        frames, newlyDropped, cursors[d] = session.frames.readSince(cursors[d])
+        batches.append(frames)
+        dropped.append(newlyDropped)
+    owners = np.repeat(np.arange(len(sessions)), [len(frames) for frames in batches])
+    return np.concatenate(batches), owners, np.array(dropped)
 
-# relative beta returned, process if it's the last to show up
-def bHandler(unused_addr, ch1, ch2, ch3, ch4):
-    global lastB
-    lastB = [ch1, ch2, ch3, ch4]
-    tryProcess()
+# Draw everything received by all sessions, at a fixed rate, until the window is closed.
+def renderLoop(oscReceiver, fps=RENDER_FPS):
+    sessions = oscReceiver.sessions
+    fig = plots[0][0][0].ax.figure
+    panels = [plot for devicePlots in plots for plotRow in devicePlots for plot in plotRow]
+    blit = blitter.Blitter(fig, panels) if BLIT else None
+    cursors = [0] * len(sessions)
+    dropped, rendered = np.zeros(len(sessions), dtype=int), np.zeros(len(sessions), dtype=int)
+    lastStats = time.time()
+    while plt.get_fignums():
+        frameStart = time.time()
+        frames, owners, newlyDropped = readSessions(sessions, cursors)
+        _, g, t, b = receiver.splitFrames(frames)
+        logTBR = np.log(t / b) # Use log ratio for now, for all devices at once
+        for i in range(len(frames)):
+            process(plots[owners[i]], g[i], logTBR[i])
+        dropped += newlyDropped
+        rendered += np.bincount(owners, minlength=len(sessions))
 
-# relative theta, process if it's the last to show up
-def tHandler(unused_addr, ch1, ch2, ch3, ch4):
-    global lastT
-    lastT = [ch1, ch2, ch3, ch4]
-    tryProcess()
+        if frameStart - lastStats > STATS_SEC:
+            for d, session in enumerate(sessions):
+                assembly = session.assembler.stats()
+                print("%s: received %d messages (%d partial, %d dropped, %d late), %d frames: %d dropped, %d rendered" % (
+                    session.name, session.received, assembly['partial'], assembly['dropped'], assembly['late'],
+                    session.frames.written, dropped[d], rendered[d]))
+                for i in range(4):
+                    summary = channelHist(plots[d], i).stats.summary()
+                    if summary['n'] > 0:
+                        print("  %s: log TBR mean %.3f, std %.3f, median %.3f, recent mean %.3f" % (
+                            getTitle(i), summary['mean'], summary['std'], summary['median'], summary['recentMean']))
+            lastStats = frameStart
+        remaining = max(1. / fps - (time.time() - frameStart), 0.001)
+        if blit is not None:
+            blit.render()
+            fig.canvas.start_event_loop(remaining)
+        else:
+            for panel in panels:
+                panel.update()
+            plt.pause(remaining)
 
 # Convert channel id (0-3) to name.
 def getTitle(channel):
@@ -74,9 +113,21 @@ def getTitle(channel):
         'TP10 (right ear)',
     ][channel]
 
+# Add each channel's stats from this session to those saved in path (if any), and save them back.
+def saveBaselines(path, sessions):
+    baselines = livestats.loadBaselines(path) if os.path.exists(path) else {}
+    for session, devicePlots in zip(sessions, plots):
+        channels = baselines.setdefault(session.name, {})
+        for i in range(4):
+            stats = channelHist(devicePlots, i).stats
+            channels[i] = channels[i].merge(stats) if i in channels else stats
+    livestats.saveBaselines(path, baselines)
+    print("Saved baselines to %s" % path)
+
 if __name__ == "__main__":
     # Note: Serve Muse by running:
     #   ./muse-io --osc osc.udp://localhost:5000 --device <device ID>
+    # and for more headsets, e.g. another on port 5001 with --device 5000 --device 5001
     parser = argparse.ArgumentParser()
     parser.add_argument("--ip",
                         default="127.0.0.1",
@@ -84,30 +135,43 @@ if __name__ == "__main__":
     parser.add_argument("--port",
                         type=int,
                         default=5000,
-                        help="The port to listen on")
+                        help="The port to listen on, for a single device")
+    parser.add_argument("--device",
+                        action="append",
+                        help="A device to listen for, as port or port:prefix, e.g. 5001 or 5000:/muse2."
+                             " Repeat for multiple headsets; overrides --port")
+    parser.add_argument("--baselines",
+                        help="JSON file of per-channel TBR stats, to add this session's to on exit")
     args = parser.parse_args()
+    devices = [receiver.parseDevice(spec) for spec in args.device or [str(args.port)]]
 
-    # Listen to OSC channels we care about:
-    dispatcher = dispatcher.Dispatcher()
-    dispatcher.map("/debug", print)
-    dispatcher.map("/muse/elements/is_good", gHandler)
-    dispatcher.map("/muse/elements/beta_relative", bHandler)
-    dispatcher.map("/muse/elements/theta_relative", tHandler)
-
-    # Build live graphs
-    axes = cleanSubplots()
-    for i in range(len(axes)):
-        plotRow = []
-        for j in range(len(axes[i])):
-            title = getTitle(i * 2 + j // 2)
-            if j % 2 == 0:
-                plotRow.append(livegraph.LiveGraph(axes[i][j], title))
-            else:
-                plotRow.append(livehist.LiveHist(axes[i][j], title))
-        plots.append(plotRow)
+    # Build live graphs, two rows per device.
+    sessions = []
+    axes = cleanSubplots(r=2 * len(devices))
+    for d, (port, prefix) in enumerate(devices):
+        name = "%d%s" % (port, prefix)
+        sessions.append(receiver.Session(name, port, prefix))
+        devicePlots = []
+        for i in range(2):
+            plotRow = []
+            for j in range(len(axes[i])):
+                title = getTitle(i * 2 + j // 2)
+                if len(devices) > 1:
+                    title = name + ' ' + title
+                if j % 2 == 0:
+                    plotRow.append(livegraph.LiveGraph(axes[2*d + i][j], title, blit=BLIT))
+                else:
+                    plotRow.append(livehist.LiveHist(axes[2*d + i][j], title, blit=BLIT,
+                                                     adaptive=ADAPTIVE_RANGE, halfLife=RECENT_HALF_LIFE))
+            devicePlots.append(plotRow)
+        plots.append(devicePlots)
 
-    # server = osc_server.ThreadingOSCUDPServer(
-    server = osc_server.BlockingOSCUDPServer(
-        (args.ip, args.port), dispatcher)
-    print("Serving on {}".format(server.server_address))
-    server.serve_forever()
+    # Listen to OSC channels we care about for all devices on a background thread, drawing on this one.
+    oscReceiver = receiver.Receiver(args.ip, sessions)
+    oscReceiver.start()
+    try:
+        renderLoop(oscReceiver)
+    finally:
+        oscReceiver.stop()
+        if args.baselines:
+            saveBaselines(args.baselines, sessions)
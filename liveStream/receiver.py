@@ -0,0 +1,192 @@
+# OSC ingestion for the live Muse TBR grapher, kept separate from any drawing.
+# The OSC handlers only parse values into a ring buffer per device, on a background
+# thread, so a slow display never holds up receiving. Renderers (see plot.py) read
+# from the buffers at whatever rate they can manage. Doesn't need matplotlib.
+
+import selectors
+import socket
+import struct
+import sys
+import threading
+import time
+
+import numpy as np
+
+# pip3 install python-osc
+from pythonosc import dispatcher
+from pythonosc import osc_server
+
+from frames import FrameAssembler
+from ringbuffer import RingBuffer
+
+N_CHANNELS = 4
+# Frames kept for readers to catch up on, ~7 minutes at the Muse's 10hz.
+RING_FRAMES = 4096
+# Raw EEG samples kept, if subscribed to: a minute at the Muse's 256hz.
+RAW_RING_SAMPLES = 256 * 60
+# Size of the socket receive buffer, so bursts wait in the kernel rather than being dropped.
+SOCKET_BUFFER_BYTES = 1 << 20
+# OSC address prefix muse-io uses by default.
+DEFAULT_PREFIX = "/muse"
+# Seconds expected between frames: the Muse sends each value at 10hz. The assembler measures
+# the actual period as messages arrive, and pairs messages within half of it (see frames.py).
+FRAME_PERIOD_SEC = 0.1
+# Messages kept per value while waiting for the others to arrive.
+PENDING_MESSAGES = 16
+# Socket option for the kernel to timestamp each packet as it arrives. Linux's value, which
+# the socket module doesn't name; elsewhere packets are timed when they're read instead.
+SO_TIMESTAMP = getattr(socket, 'SO_TIMESTAMP', 29 if sys.platform.startswith('linux') else None)
+# The kernel's timestamp: a struct timeval, seconds and microseconds.
+TIMEVAL = struct.Struct('@ll')
+
+# Frame rows are: [time assembled, isGood x4, theta x4, beta x4]
+FRAME_WIDTH = 1 + 3 * N_CHANNELS
+# Raw rows are: [arrival time, eeg x4]
+RAW_WIDTH = 1 + N_CHANNELS
+
+# Split a frame row into (time, isGood, theta, beta); works on a single row or many.
+def splitFrames(frames):
+    n = N_CHANNELS
+    return frames[..., 0], frames[..., 1:1+n], frames[..., 1+n:1+2*n], frames[..., 1+2*n:1+3*n]
+
+# Parse a device spec of "port" or "port:prefix", e.g. "5001" or "5000:/muse2"
+def parseDevice(spec):
+    port, _, prefix = spec.partition(':')
+    return int(port), prefix or DEFAULT_PREFIX
+
+
+class Session:
+    """
+    One Muse headset, sending to a given port with a given OSC address prefix.
+    is_good, theta_relative and beta_relative messages arriving together are
+    paired up (see frames.py) and added as one frame to this session's ring buffer.
+    If raw, /eeg samples are also kept, in the rawSamples ring buffer.
+    """
+    def __init__(self, name, port, prefix=DEFAULT_PREFIX, ringFrames=RING_FRAMES,
+                 framePeriod=FRAME_PERIOD_SEC, raw=False):
+        self.name = name
+        self.port = port
+        self.prefix = prefix
+        self.frames = RingBuffer(ringFrames, FRAME_WIDTH)
+        self.assembler = FrameAssembler(("g", "t", "b"), self.storeFrame, framePeriod, PENDING_MESSAGES)
+        self.rawSamples = RingBuffer(RAW_RING_SAMPLES, RAW_WIDTH) if raw else None
+        self.received = 0 # OSC messages handled
+        # When the message being handled arrived. The Receiver replaces this with its packet times.
+        self.arrivalTime = time.time
+
+    def mapTo(self, oscDispatcher):
+        """
+        Listen to the OSC channels we care about, on the given dispatcher.
+        """
+        oscDispatcher.map(self.prefix + "/elements/is_good", self.gHandler)
+        oscDispatcher.map(self.prefix + "/elements/beta_relative", self.bHandler)
+        oscDispatcher.map(self.prefix + "/elements/theta_relative", self.tHandler)
+        if self.rawSamples is not None:
+            oscDispatcher.map(self.prefix + "/eeg", self.eegHandler)
+
+    # Pass a value on to be paired with the others, by arrival time
+    def receive(self, stream, values):
+        self.received += 1
+        self.assembler.push(stream, self.arrivalTime(), values)
+
+    # All values for a frame are available, store it, as of now: readers can't see it any sooner.
+    def storeFrame(self, frameTime, values):
+        self.frames.append(np.concatenate(([time.time()], values['g'], values['t'], values['b'])))
+
+    # isGood returned
+    def gHandler(self, unused_addr, ch1, ch2, ch3, ch4):
+        self.receive('g', [ch1, ch2, ch3, ch4])
+
+    # relative beta returned
+    def bHandler(self, unused_addr, ch1, ch2, ch3, ch4):
+        self.receive('b', [ch1, ch2, ch3, ch4])
+
+    # relative theta returned
+    def tHandler(self, unused_addr, ch1, ch2, ch3, ch4):
+        self.receive('t', [ch1, ch2, ch3, ch4])
+
+    # raw EEG sample, possibly followed by auxiliary channels which are ignored
+    def eegHandler(self, unused_addr, *values):
+        self.received += 1
+        self.rawSamples.append([time.time()] + list(values[:N_CHANNELS]))
+
+
+class TimestampedOSCUDPServer(osc_server.BlockingOSCUDPServer):
+    '''
+    OSC server noting when each packet arrived (packetTime) while its handlers run.
+    Where the kernel can timestamp packets, that's when it received them, so the times stay
+    accurate even if this process falls behind and then reads a backlog all at once.
+    '''
+    def server_bind(self):
+        super().server_bind()
+        self.packetTime = None
+        self.kernelTimes = False
+        if SO_TIMESTAMP is not None and hasattr(self.socket, 'recvmsg'):
+            try:
+                self.socket.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMP, 1)
+                self.kernelTimes = True
+            except OSError:
+                pass
+
+    def get_request(self):
+        if not self.kernelTimes:
+            data, address = self.socket.recvfrom(self.max_packet_size)
+            self.packetTime = time.time()
+            return (data, self.socket), address
+        data, ancillary, _, address = self.socket.recvmsg(self.max_packet_size, socket.CMSG_SPACE(TIMEVAL.size))
+        self.packetTime = time.time()
+        for level, kind, payload in ancillary:
+            if level == socket.SOL_SOCKET and kind == SO_TIMESTAMP:
+                seconds, micros = TIMEVAL.unpack(payload[:TIMEVAL.size])
+                self.packetTime = seconds + micros * 1e-6
+        return (data, self.socket), address
+
+
+class Receiver:
+    """
+    Receives OSC for any number of sessions, on one background thread.
+    Sessions on the same port share a socket, and are told apart by their prefix.
+    """
+    def __init__(self, ip, sessions):
+        self.sessions = sessions
+        self.servers = []
+        for port in sorted(set(session.port for session in sessions)):
+            oscDispatcher = dispatcher.Dispatcher()
+            oscDispatcher.map("/debug", print)
+            server = TimestampedOSCUDPServer((ip, port), oscDispatcher)
+            server.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_BYTES)
+            for session in sessions:
+                if session.port == port:
+                    session.mapTo(oscDispatcher)
+                    session.arrivalTime = lambda server=server: server.packetTime
+            self.servers.append(server)
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """
+        Start receiving on a background thread.
+        """
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+        for server in self.servers:
+            print("Serving on {}".format(server.server_address))
+
+    def serve(self):
+        """
+        Handle packets for all ports as they arrive, until stopped.
+        """
+        with selectors.DefaultSelector() as selector:
+            for server in self.servers:
+                selector.register(server.socket, selectors.EVENT_READ, server)
+            while self.running:
+                for key, _ in selector.select(timeout=0.1):
+                    key.data.handle_request()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        for server in self.servers:
+            server.server_close()
@@ -0,0 +1,182 @@
+# Headless recorder for the Muse OSC stream: no plotting, just frames appended to disk.
+# Light enough to leave running for hours on small boards where matplotlib is too heavy.
+#
+# Logs are a 16 byte header followed by float64 rows, in receiver.py's frame layout:
+#   [time assembled, isGood x4, theta x4, beta x4]
+# Read them back with readLog, which memory-maps rather than loading the whole file.
+
+import argparse
+import os
+import struct
+import time
+
+import numpy as np
+
+import receiver
+
+MAGIC = b"TBRLOG1\0"
+HEADER = struct.Struct("<8sII") # magic, frame width, reserved
+# How often frames received are written out, in seconds.
+FLUSH_SEC = 1.0
+# How often written frames are forced to disk, in seconds.
+FSYNC_SEC = 10.0
+# How often to print the per-device counters, in seconds.
+STATS_SEC = 60
+# Frames histogrammed at a time when reading, so memory stays flat for long logs.
+CHUNK_FRAMES = 1 << 16
+
+
+class FrameLog:
+    """
+    Append-only log of frames. Each append is one write of the whole batch;
+    data is fsync'd at most every fsyncSec, and on close.
+    """
+    def __init__(self, path, width=receiver.FRAME_WIDTH, fsyncSec=FSYNC_SEC):
+        self.path = path
+        self.width = width
+        self.fsyncSec = fsyncSec
+        self.written = 0
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        if exists:
+            checkHeader(path, width)
+        self.file = open(path, "ab")
+        if not exists:
+            self.file.write(HEADER.pack(MAGIC, width, 0))
+        else:
+            # Drop any partial row left by a crash mid-write, so rows stay aligned.
+            rowBytes = 8 * width
+            extra = (os.path.getsize(path) - HEADER.size) % rowBytes
+            if extra:
+                self.file.truncate(os.path.getsize(path) - extra)
+        self.lastSync = time.time()
+
+    def append(self, rows):
+        """
+        Write a batch of rows to the end of the log, syncing if it's been long enough.
+        """
+        if len(rows):
+            self.file.write(np.ascontiguousarray(rows, dtype='<f8').tobytes())
+            self.written += len(rows)
+        if time.time() - self.lastSync > self.fsyncSec:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.lastSync = time.time()
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+# Make sure a file is a frame log with rows of the given width (or any width, if None), returning the width.
+def checkHeader(path, width=None):
+    with open(path, "rb") as f:
+        magic, fileWidth, _ = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError("%s is not a frame log" % path)
+    if width is not None and fileWidth != width:
+        raise ValueError("%s has frames of width %d, expected %d" % (path, fileWidth, width))
+    return fileWidth
+
+# Memory-map all complete frames in a log, read-only.
+def readLog(path):
+    width = checkHeader(path)
+    nFrames = (os.path.getsize(path) - HEADER.size) // (8 * width)
+    if nFrames == 0:
+        return np.zeros((0, width))
+    return np.memmap(path, dtype='<f8', mode='r', offset=HEADER.size, shape=(nFrames, width))
+
+# Histogram the log TBR of each channel in frames, bucketed the same way as LiveHist.
+# Frames with a channel not good are skipped for that channel, like the live view, as are
+# log TBRs that aren't finite (theta or beta of zero, or missing).
+# Returns (bucket centres, counts per channel and bucket)
+def histogram(frames, segments=20, minX=-2.0, maxX=2.0):
+    segWidth = (maxX - minX) / segments
+    xs = minX + (np.arange(0, segments) + 0.5) * segWidth
+    counts = np.zeros((receiver.N_CHANNELS, segments), dtype=np.int64)
+    for start in range(0, len(frames), CHUNK_FRAMES):
+        _, g, t, b = receiver.splitFrames(np.asarray(frames[start:start + CHUNK_FRAMES]))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            logTBR = np.log(t / b)
+        finite = np.isfinite(logTBR)
+        buckets = np.clip(np.floor(segments * (np.where(finite, logTBR, minX) - minX) / (maxX - minX)), 0, segments - 1)
+        for channel in range(receiver.N_CHANNELS):
+            good = (g[:, channel] == 1) & finite[:, channel]
+            counts[channel] += np.bincount(buckets[good, channel].astype(int), minlength=segments)
+    return xs, counts
+
+# Path of the log for a device, given the output prefix.
+def logPath(out, port, prefix):
+    return "%s_%d%s.tbr" % (out, port, prefix.replace("/", "_"))
+
+# Write frames from each session into its log until interrupted.
+def recordLoop(sessions, logs, flushSec=FLUSH_SEC):
+    cursors = [0] * len(sessions)
+    dropped = [0] * len(sessions)
+    lastStats = time.time()
+    try:
+        while True:
+            time.sleep(flushSec)
+            for d, (session, log) in enumerate(zip(sessions, logs)):
+                frames, newlyDropped, cursors[d] = session.frames.readSince(cursors[d])
+                log.append(frames)
+                dropped[d] += newlyDropped
+            if time.time() - lastStats > STATS_SEC:
+                for d, (session, log) in enumerate(zip(sessions, logs)):
+                    print("%s: received %d messages, %d frames: %d dropped, %d written" % (
+                        session.name, session.received, session.frames.written, dropped[d], log.written))
+                lastStats = time.time()
+    except KeyboardInterrupt:
+        pass
+
+# Print the length and per-channel histograms of a recorded log.
+def summarize(path):
+    frames = readLog(path)
+    print("%s: %d frames" % (path, len(frames)))
+    if len(frames) == 0:
+        return
+    print("  %.1f seconds, from %s" % (frames[-1, 0] - frames[0, 0], time.ctime(frames[0, 0])))
+    xs, counts = histogram(frames)
+    print("  log TBR buckets: " + " ".join("%5.1f" % x for x in xs))
+    for channel in range(receiver.N_CHANNELS):
+        print("  channel %d:        %s" % (channel, " ".join("%5d" % c for c in counts[channel])))
+
+if __name__ == "__main__":
+    # Note: Serve Muse the same way as for plot.py, e.g.
+    #   ./muse-io --osc osc.udp://localhost:5000 --device <device ID>
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ip",
+                        default="127.0.0.1",
+                        help="The ip to listen on")
+    parser.add_argument("--port",
+                        type=int,
+                        default=5000,
+                        help="The port to listen on, for a single device")
+    parser.add_argument("--device",
+                        action="append",
+                        help="A device to listen for, as port or port:prefix. Repeat for multiple headsets")
+    parser.add_argument("--out",
+                        default="recording",
+                        help="Prefix for the log files written, one per device")
+    parser.add_argument("--summarize",
+                        nargs="+",
+                        help="Instead of recording, print a summary of these logs")
+    args = parser.parse_args()
+
+    if args.summarize:
+        for path in args.summarize:
+            summarize(path)
+    else:
+        devices = [receiver.parseDevice(spec) for spec in args.device or [str(args.port)]]
+        sessions = [receiver.Session("%d%s" % device, *device) for device in devices]
+        logs = [FrameLog(logPath(args.out, port, prefix)) for port, prefix in devices]
+        oscReceiver = receiver.Receiver(args.ip, sessions)
+        oscReceiver.start()
+        try:
+            recordLoop(sessions, logs)
+        finally:
+            oscReceiver.stop()
+            for log in logs:
+                log.close()
+                print("Wrote %d frames to %s" % (log.written, log.path))
@@ -0,0 +1,172 @@
+# Sends Muse-style OSC to the live tools without a headset, from a recording (see record.py)
+# or made up, at any rate. Also benchmarks the receiving side, for latency and drops.
+#
+# e.g. drive plot.py at 10x real time:  python3 replay.py --port 5000 --rate 100
+#      replay a recording:              python3 replay.py --log recording_5000_muse.tbr
+#      benchmark the receiver:          python3 replay.py --benchmark --rates 100 1000 10000
+
+import argparse
+import socket
+import threading
+import time
+
+import numpy as np
+
+from pythonosc import osc_message_builder
+
+import receiver
+
+# Rate the Muse sends each value at, frames per second.
+MUSE_RATE = 10
+# How often the benchmark reads frames out of the receiver, in seconds.
+DRAIN_SEC = 0.01
+# How long the benchmark waits after sending for stragglers, in seconds.
+SETTLE_SEC = 0.5
+# How long to send for at each benchmark rate by default, in seconds.
+BENCHMARK_SEC = 5
+
+# Build one OSC message as bytes, with either int or float arguments.
+def oscMessage(address, values, argType):
+    builder = osc_message_builder.OscMessageBuilder(address)
+    for value in values:
+        builder.add_arg(value, argType)
+    return builder.build().dgram
+
+# Encode frames (rows in receiver.py's layout) as the is_good, theta, beta messages muse-io sends.
+def frameMessages(frames, prefix=receiver.DEFAULT_PREFIX):
+    _, g, t, b = receiver.splitFrames(frames)
+    return [(
+        oscMessage(prefix + "/elements/is_good", [int(v) for v in g[i]], 'i'),
+        oscMessage(prefix + "/elements/theta_relative", t[i], 'f'),
+        oscMessage(prefix + "/elements/beta_relative", b[i], 'f'),
+    ) for i in range(len(frames))]
+
+# Made-up frames: all channels good, relative theta and beta between 0.05 and 0.55.
+# If numbered, is_good, theta and beta of the first channel are all the frame number instead, to match
+# received frames to sent ones, and catch frames assembled from different frames' messages.
+def syntheticFrames(nFrames, numbered=False, seed=0):
+    rng = np.random.default_rng(seed)
+    frames = np.zeros((nFrames, receiver.FRAME_WIDTH))
+    _, g, t, b = receiver.splitFrames(frames)
+    g[:] = 1
+    t[:] = 0.05 + rng.random(t.shape) / 2
+    b[:] = 0.05 + rng.random(b.shape) / 2
+    if numbered:
+        g[:, 0] = t[:, 0] = b[:, 0] = np.arange(nFrames)
+    return frames
+
+# Send frames' messages to ip:port at the given number of frames per second, as closely as possible.
+# Returns the time each frame finished sending.
+def send(messages, ip, port, rate):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sentAt = np.zeros(len(messages))
+    start = time.time()
+    for i, frame in enumerate(messages):
+        ahead = start + i / rate - time.time()
+        if ahead > 0:
+            time.sleep(ahead)
+        for dgram in frame:
+            sock.sendto(dgram, (ip, port))
+        sentAt[i] = time.time()
+    sock.close()
+    return sentAt
+
+# Send numbered frames at the given rate to a receiver in this process, and measure
+# how long each took to come out as a frame, how many never did, and how many came out
+# mixing messages from different frames.
+def benchmark(rate, nFrames, ip="127.0.0.1", port=5099):
+    session = receiver.Session("benchmark", port)
+    oscReceiver = receiver.Receiver(ip, [session])
+    oscReceiver.start()
+    messages = frameMessages(syntheticFrames(nFrames, numbered=True))
+
+    result = {}
+    sender = threading.Thread(target=lambda: result.update(sentAt=send(messages, ip, port, rate)))
+    batches, cursor, ringDropped = [], 0, 0
+    sender.start()
+    while sender.is_alive():
+        time.sleep(DRAIN_SEC)
+        frames, newlyDropped, cursor = session.frames.readSince(cursor)
+        batches.append(frames)
+        ringDropped += newlyDropped
+    time.sleep(SETTLE_SEC)
+    frames, newlyDropped, cursor = session.frames.readSince(cursor)
+    batches.append(frames)
+    ringDropped += newlyDropped
+    oscReceiver.stop()
+
+    frames = np.concatenate(batches)
+    arrivedAt, g, t, b = receiver.splitFrames(frames)
+    mismatched = (g[:, 0] != t[:, 0]) | (b[:, 0] != t[:, 0])
+    sentAt = result['sentAt']
+    latencies = (arrivedAt - sentAt[t[:, 0].astype(int)]) * 1000
+    percentiles = np.percentile(latencies, [50, 90, 99, 100]) if len(latencies) else [np.nan] * 4
+    report = {
+        'rate': rate,
+        'achievedRate': (nFrames - 1) / (sentAt[-1] - sentAt[0]) if nFrames > 1 else np.nan,
+        'sent': nFrames,
+        'received': len(frames),
+        'lost': 1 - len(frames) / nFrames,
+        'mismatched': int(np.count_nonzero(mismatched)),
+        'messages': session.received,
+        'ringDropped': ringDropped,
+        'p50ms': percentiles[0], 'p90ms': percentiles[1], 'p99ms': percentiles[2], 'maxms': percentiles[3],
+    }
+    report.update(session.assembler.stats())
+    return report
+
+# Print benchmark results, one line per rate.
+def printReports(reports):
+    print("%9s %9s %7s %7s %8s %8s %8s %7s %7s %7s %7s %8s %8s %8s %8s" % (
+        "rate", "achieved", "sent", "frames", "lost", "mismatch", "messages", "partial", "qdrop", "late", "ring",
+        "p50 ms", "p90 ms", "p99 ms", "max ms"))
+    for r in reports:
+        print("%9d %9.0f %7d %7d %7.2f%% %8d %8d %7d %7d %7d %7d %8.2f %8.2f %8.2f %8.2f" % (
+            r['rate'], r['achievedRate'], r['sent'], r['received'], 100 * r['lost'], r['mismatched'], r['messages'],
+            r['partial'], r['dropped'], r['late'], r['ringDropped'],
+            r['p50ms'], r['p90ms'], r['p99ms'], r['maxms']))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ip",
+                        default="127.0.0.1",
+                        help="The ip to send to")
+    parser.add_argument("--port",
+                        type=int,
+                        default=5000,
+                        help="The port to send to")
+    parser.add_argument("--prefix",
+                        default=receiver.DEFAULT_PREFIX,
+                        help="OSC address prefix to send with")
+    parser.add_argument("--rate",
+                        type=float,
+                        default=MUSE_RATE,
+                        help="Frames sent per second")
+    parser.add_argument("--frames",
+                        type=int,
+                        default=None,
+                        help="Number of frames to send (default: all of the log, 10 minutes' worth,"
+                             " or %d seconds' worth per benchmark rate)" % BENCHMARK_SEC)
+    parser.add_argument("--log",
+                        help="Replay frames from a recording made by record.py, rather than made up ones")
+    parser.add_argument("--benchmark",
+                        action="store_true",
+                        help="Instead of sending elsewhere, measure a receiver in this process")
+    parser.add_argument("--rates",
+                        type=float,
+                        nargs="+",
+                        default=[MUSE_RATE, 100, 1000, 10000],
+                        help="Frames per second to benchmark at")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        printReports([benchmark(rate, args.frames or int(max(rate * BENCHMARK_SEC, 50))) for rate in args.rates])
+    else:
+        if args.log:
+            import record
+            frames = np.asarray(record.readLog(args.log)[:args.frames])
+        else:
+            frames = syntheticFrames(args.frames or 600 * MUSE_RATE)
+        print("Sending %d frames to %s:%d at %g per second" % (len(frames), args.ip, args.port, args.rate))
+        sentAt = send(frameMessages(frames, args.prefix), args.ip, args.port, args.rate)
+        print("Sent in %.1f seconds" % (sentAt[-1] - sentAt[0] if len(sentAt) else 0))
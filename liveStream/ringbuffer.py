@@ -0,0 +1,43 @@
+# Fixed-size buffer of the most recent rows, shared between a writer and reader thread.
+
+import threading
+
+import numpy as np
+
+class RingBuffer:
+    """
+    Preallocated ring of float rows. One thread appends, others read everything
+    written since they last looked, using a cursor (the total written at that point).
+    Rows overwritten before a reader gets to them are reported as dropped to that reader.
+    """
+    def __init__(self, capacity, width):
+        self.capacity = capacity
+        self.rows = np.zeros((capacity, width))
+        self.written = 0
+        self.lock = threading.Lock()
+
+    def append(self, row):
+        """
+        Add a single row, overwriting the oldest if full.
+        """
+        with self.lock:
+            self.rows[self.written % self.capacity] = row
+            self.written += 1
+
+    def readSince(self, cursor):
+        """
+        Copy out the rows written since cursor, oldest first.
+        Returns (rows, number dropped since cursor, new cursor)
+        """
+        with self.lock:
+            written = self.written
+            start = max(cursor, written - self.capacity)
+            rows = self.rows[np.arange(start, written) % self.capacity]
+        return rows, start - cursor, written
+
+    def latest(self, n):
+        """
+        Copy out the last (up to) n rows written, oldest first.
+        """
+        rows, _, _ = self.readSince(max(self.written - n, 0))
+        return rows
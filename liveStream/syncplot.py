@@ -0,0 +1,96 @@
+import argparse
+import matplotlib.pyplot as plt
+import time
+
+# Live 4x4 synchronization matrix per headset, from the raw /muse/eeg stream (see livesync.py).
+# Like plot.py, receiving happens on a background thread (receiver.py), drawing on this one.
+
+import blitter
+import livematrix
+import livesync
+import receiver
+
+# Frames drawn per second. Synchronization is updated (within its budget) once per frame.
+RENDER_FPS = 20
+# How often to print the received / processed / skipped counters, in seconds.
+STATS_SEC = 5
+# Whether to redraw only the matrices (see blitter.py), rather than the full figure.
+BLIT = True
+# Colour range of the matrix. BS(k, k) is just under 1, unrelated channels near P_REF.
+MIN_SYNC, MAX_SYNC = 0.0, 1.0
+
+CHANNEL_NAMES = ['TP9', 'Fp1', 'Fp2', 'TP10']
+
+# Update each device's synchronization and draw it, at a fixed rate, until the window is closed.
+def renderLoop(oscReceiver, syncs, matrices, fps=RENDER_FPS):
+    fig = matrices[0].ax.figure
+    blit = blitter.Blitter(fig, matrices) if BLIT else None
+    lastStats = time.time()
+    while plt.get_fignums():
+        frameStart = time.time()
+        for sync, matrix in zip(syncs, matrices):
+            sync.update()
+            bsls = sync.bsls()
+            if bsls is not None:
+                matrix.set(bsls)
+
+        if frameStart - lastStats > STATS_SEC:
+            for sync in syncs:
+                print("%s: received %d samples, %d reference points processed, %d pending, %d skipped, %d restarts" % (
+                    sync.session.name, sync.session.rawSamples.written, sync.processed, sync.pending(),
+                    sync.skipped, sync.restarts))
+            lastStats = frameStart
+        remaining = max(1. / fps - (time.time() - frameStart), 0.001)
+        if blit is not None:
+            blit.render()
+            fig.canvas.start_event_loop(remaining)
+        else:
+            for matrix in matrices:
+                matrix.update()
+            plt.pause(remaining)
+
+if __name__ == "__main__":
+    # Note: Serve Muse by running:
+    #   ./muse-io --osc osc.udp://localhost:5000 --device <device ID>
+    # then, from liveStream/ (livesync.py needs the repository root on the path):
+    #   PYTHONPATH=.. python3 syncplot.py
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ip",
+                        default="127.0.0.1",
+                        help="The ip to listen on")
+    parser.add_argument("--port",
+                        type=int,
+                        default=5000,
+                        help="The port to listen on, for a single device")
+    parser.add_argument("--device",
+                        action="append",
+                        help="A device to listen for, as port or port:prefix, e.g. 5001 or 5000:/muse2."
+                             " Repeat for multiple headsets; overrides --port")
+    parser.add_argument("--window",
+                        type=float,
+                        default=livesync.WINDOW_SEC,
+                        help="Seconds of signal each matrix is averaged over")
+    parser.add_argument("--rate",
+                        type=int,
+                        default=livesync.MUSE_RAW_RATE,
+                        help="Sample rate of the raw EEG")
+    args = parser.parse_args()
+    devices = [receiver.parseDevice(spec) for spec in args.device or [str(args.port)]]
+
+    # One matrix per device, side by side.
+    fig, axes = plt.subplots(1, len(devices), squeeze=False)
+    sessions, syncs, matrices = [], [], []
+    for d, (port, prefix) in enumerate(devices):
+        name = "%d%s" % (port, prefix)
+        session = receiver.Session(name, port, prefix, raw=True)
+        sessions.append(session)
+        syncs.append(livesync.LiveSync(session, args.rate, windowSec=args.window))
+        matrices.append(livematrix.LiveMatrix(axes[0][d], name + ' BS', CHANNEL_NAMES,
+                                              MIN_SYNC, MAX_SYNC, blit=BLIT))
+
+    oscReceiver = receiver.Receiver(args.ip, sessions)
+    oscReceiver.start()
+    try:
+        renderLoop(oscReceiver, syncs, matrices)
+    finally:
+        oscReceiver.stop()
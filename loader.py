@@ -0,0 +1,137 @@
+"""
+Loading of EEG trials from the edf files in data/, shared by the analysis scripts.
+Files are opened without preloading: cropping only moves the start and end, and
+ reading then only touches the picked channels within that time range,
+ rather than decoding every channel of the whole recording first.
+If a trial has been converted with convert.edfToCache, and the edf hasn't changed since,
+ it is read from the memory-mapped cache instead, skipping edf decoding altogether.
+"""
+
+import hashlib
+import json
+import os
+
+import mne
+import mne.io
+import numpy as np
+
+DATA_DIR = "data/"
+CACHE_DIR = DATA_DIR + "cache/"
+# Whether to read trials from the binary cache when available.
+USE_CACHE = True
+
+# Every trial in data/, with its bad channels, as used by the analysis scripts.
+BAD_CHANNELS = {
+    'T013_D001_V00_2017_05_16_Emily-Resting-30Hzfilt.edf': ['STI 014', 'EEG 55', 'EEG VREF'],
+    'T013_D002_V00_2017_05_16_Emily-Focus-30Hzfilt.edf': ['STI 014', 'EEG 55', 'EEG VREF'],
+    'T013_D003_V00_2017_05_16_Giulio-Resting-State-30Hzfilt.edf': ['STI 014', 'EEG 10', 'EEG 63', 'EEG VREF'],
+    'T013_D004_V00_2017_05_16_Giulio-Focused-30Hzfilt.edf': ['STI 014', 'EEG 10', 'EEG 63', 'EEG VREF'],
+    'T013_D005_V00_2017_05_15_Patrick-Resting-State-30Hzfilt.edf': ['STI 014', 'EEG 10', 'EEG 63', 'EEG VREF'],
+    'T013_D006_V00_2017_05_15_Patrick-Focus-30Hzfilt.edf': ['STI 014', 'EEG 10', 'EEG 63', 'EEG VREF'],
+    'T013_D007_V00_2017_05_16_MichaelH-Resting-State-30Hzfilt.edf': ['STI 014', 'EEG 10', 'EEG 63', 'EEG VREF'],
+    'T013_D008_V00_2017_05_16_MichaelH-Focus-30Hzfilt.edf': ['STI 014', 'EEG 10', 'EEG 63', 'EEG VREF'],
+    'T013_D009_V00_2017_05_15_Yana-Resting-State-30Hzfilt.edf': ['STI 014', 'EEG 18', 'EEG 23', 'EEG 46', 'EEG 56', 'EEG VREF'],
+    'T013_D010_V00_2017_05_15_Yana-Focus-30Hzfilt.edf': ['STI 014', 'EEG 18', 'EEG 56', 'EEG VREF'],
+}
+
+
+class CachedRaw(object):
+    '''
+    Stand-in for a non-preloaded mne Raw, reading from a trial in the binary cache.
+    Supports what the analysis scripts use: info, n_times, crop and get_data.
+    '''
+    def __init__(self, dataPath, meta):
+        self.data = np.load(dataPath, mmap_mode='r')
+        self.info = mne.create_info(meta['ch_names'], meta['sfreq'], meta['ch_types'], verbose=False)
+        self.first, self.n_times = 0, self.data.shape[1]
+
+    def crop(self, tmin=0., tmax=None):
+        '''Keep only [tmin, tmax] (inclusive, relative to the current start), as Raw.crop'''
+        sfreq = self.info['sfreq']
+        start = int(np.round(tmin * sfreq))
+        stop = self.n_times - 1 if tmax is None else int(np.round(tmax * sfreq))
+        if start < 0 or stop >= self.n_times or start > stop:
+            raise ValueError("Can't crop to [%s, %s], only %d samples" % (tmin, tmax, self.n_times))
+        self.first, self.n_times = self.first + start, stop - start + 1
+        return self
+
+    def get_data(self, picks=None, start=0, stop=None):
+        stop = self.n_times if stop is None else min(stop, self.n_times)
+        rows = slice(None) if picks is None else picks
+        return np.array(self.data[rows, self.first + start : self.first + stop], dtype=np.float64)
+
+
+# Paths of the (data .npy, metadata .json) cache files for an edf in the data folder
+def cachePaths(path):
+    name = os.path.splitext(os.path.basename(path))[0]
+    return CACHE_DIR + name + ".npy", CACHE_DIR + name + ".json"
+
+# Content hash of a file
+def fileHash(filePath):
+    digest = hashlib.sha1()
+    with open(filePath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Size, modification time and content hash of an edf, as stored in the cache metadata
+def sourceStamp(path):
+    edfPath = DATA_DIR + path
+    return {'size': os.path.getsize(edfPath), 'mtime': os.path.getmtime(edfPath), 'sha1': fileHash(edfPath)}
+
+def openCached(path):
+    """
+    Open a trial from the binary cache, or return None if it's not cached or out of date.
+    The edf is only re-hashed if its size or modification time changed.
+    """
+    dataPath, metaPath = cachePaths(path)
+    if not USE_CACHE or not os.path.exists(dataPath) or not os.path.exists(metaPath):
+        return None
+    with open(metaPath) as f:
+        meta = json.load(f)
+    edfPath, source = DATA_DIR + path, meta['source']
+    if os.path.exists(edfPath):
+        if os.path.getsize(edfPath) != source['size']:
+            return None
+        if os.path.getmtime(edfPath) != source['mtime']:
+            if fileHash(edfPath) != source['sha1']:
+                print("Cache for %s is out of date, reading edf instead" % path)
+                return None
+            # Touched but unchanged, remember the new time to skip hashing next time.
+            source['mtime'] = os.path.getmtime(edfPath)
+            with open(metaPath, 'w') as f:
+                json.dump(meta, f)
+    return CachedRaw(dataPath, meta)
+
+def openRaw(path, bads, startSec=None, endSec=None, verbose=None):
+    """
+    Open an edf from the data folder without reading its signal,
+    cropped to [startSec, endSec] if given, and with the given bad channels marked.
+    """
+    raw = openCached(path)
+    if raw is None:
+        raw = mne.io.read_raw_edf(DATA_DIR + path, preload=False, verbose=verbose)
+    if startSec is not None or endSec is not None:
+        raw = raw.crop(tmin=startSec or 0., tmax=endSec)
+    raw.info['bads'] = bads
+    return raw
+
+# Indexes of non-bad EEG channels, limited to those in picks if given.
+def pickIDs(raw, picks=None):
+    return mne.pick_types(raw.info, eeg=True, selection=picks)
+
+# Read the (channels x samples) data for the channel indexes given (all if None),
+# only for the cropped time range.
+def readData(raw, channelIDs=None, start=0, stop=None):
+    return raw.get_data(picks=channelIDs, start=start, stop=stop)
+
+def loadTrial(path, bads, picks=None, startSec=None, endSec=None):
+    """
+    Load the picked, non-bad EEG channels of a trial between the start and end times.
+    Same data as loading the whole file, cropping, then taking the pick_types rows.
+    Returns (data, channel names, sample rate)
+    """
+    raw = openRaw(path, bads, startSec, endSec)
+    channelIDs = pickIDs(raw, picks)
+    names = [raw.info['ch_names'][i] for i in channelIDs]
+    return readData(raw, channelIDs), names, raw.info['sfreq']
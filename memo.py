@@ -0,0 +1,180 @@
+"""
+Bounded caches for memoizing the analysis functions.
+Every cache registers itself, so they can all be cleared between trials (clearAll)
+ and their hit rates reported (stats). Clearing keeps the counts of hits and misses,
+ which add up over the process's life: take stats() before a trial and use statsSince
+ for that trial's alone.
+"""
+
+import collections
+import functools
+import sys
+
+import numpy as np
+
+# Default limits for memoized, unless given explicitly.
+DEFAULT_MAX_ENTRIES = 1 << 20
+DEFAULT_MAX_BYTES = None # No byte limit.
+
+# All caches created, in creation order.
+CACHES = []
+
+# Rough size in bytes of a cached key/value
+def sizeOf(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    return sys.getsizeof(value)
+
+
+class memoized(object):
+    '''Decorator. Caches a function's return value each time it is called.
+    If called later with the same arguments, the cached value is returned
+    (not reevaluated). At most maxEntries values (and roughly maxBytes bytes)
+    are kept, evicting the least recently used first.
+    '''
+    def __init__(self, func, maxEntries=DEFAULT_MAX_ENTRIES, maxBytes=DEFAULT_MAX_BYTES):
+        self.func = func
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.cache = collections.OrderedDict()
+        self.nBytes = 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        functools.update_wrapper(self, func)
+        CACHES.append(self)
+    def __call__(self, *args):
+        try:
+            value = self.cache[args]
+        except TypeError:
+            # uncacheable. a list, for instance.
+            # better to not cache than blow up.
+            return self.func(*args)
+        except KeyError:
+            self.misses += 1
+            value = self.func(*args)
+            self.cache[args] = value
+            self.nBytes += sizeOf(args) + sizeOf(value)
+            self.evict()
+            return value
+        self.hits += 1
+        self.cache.move_to_end(args)
+        return value
+    def evict(self):
+        '''Drop least recently used values until back within the limits.'''
+        while self.cache and (
+                (self.maxEntries is not None and len(self.cache) > self.maxEntries) or
+                (self.maxBytes is not None and self.nBytes > self.maxBytes)):
+            args, value = self.cache.popitem(last=False)
+            self.nBytes -= sizeOf(args) + sizeOf(value)
+            self.evictions += 1
+    def clear(self):
+        self.cache.clear()
+        self.nBytes = 0
+    def stats(self):
+        return cacheStats(self.__name__, self.hits, self.misses, len(self.cache), self.nBytes, self.evictions)
+    def __repr__(self):
+        '''Return the function's docstring.'''
+        return self.func.__doc__
+    def __get__(self, obj, objtype):
+        '''Support instance methods.'''
+        return functools.partial(self.__call__, obj)
+
+
+class arrayMemoized(object):
+    '''Decorator for a float function of two dense non-negative ints, e.g. E(k, n).
+    Values live in a preallocated (rows x cols) float array rather than a dict,
+    NaN marking those not calculated yet. shapeFunc() gives the array shape, and is
+    called when first needed after each clear. Arguments outside it are not cached.
+    Use via denseMemoized(shapeFunc).
+    '''
+    def __init__(self, func, shapeFunc):
+        self.func = func
+        self.shapeFunc = shapeFunc
+        self.values = None
+        self.hits, self.misses = 0, 0
+        functools.update_wrapper(self, func)
+        CACHES.append(self)
+    def __call__(self, row, col):
+        return self.get(row, col)
+    def array(self):
+        if self.values is None:
+            self.values = np.full(self.shapeFunc(), np.nan)
+        return self.values
+    def inside(self, row, col):
+        rows, cols = self.array().shape
+        return 0 <= row < rows and 0 <= col < cols
+    def get(self, row, col):
+        if not self.inside(row, col):
+            return self.func(row, col)
+        value = self.values[row, col]
+        if np.isnan(value):
+            self.misses += 1
+            value = self.func(row, col)
+            self.values[row, col] = value
+        else:
+            self.hits += 1
+        return value
+    def column(self, col):
+        '''All cached rows for one column, or None if any are missing.'''
+        if not self.inside(0, col):
+            return None
+        values = self.values[:, col]
+        if np.isnan(values).any():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return values
+    def storeColumn(self, col, values):
+        '''Cache a whole column at once, for when all rows are calculated together.'''
+        if self.inside(0, col):
+            self.values[:, col] = values
+    def clear(self):
+        self.values = None
+    def stats(self):
+        nBytes = 0 if self.values is None else self.values.nbytes
+        entries = 0 if self.values is None else int(np.count_nonzero(~np.isnan(self.values)))
+        return cacheStats(self.__name__, self.hits, self.misses, entries, nBytes, 0)
+
+
+# Decorator: memoized, with limits other than the defaults.
+def boundedMemoized(maxEntries=DEFAULT_MAX_ENTRIES, maxBytes=DEFAULT_MAX_BYTES):
+    return lambda func: memoized(func, maxEntries, maxBytes)
+
+# Decorator: arrayMemoized, storing values in an array of shape shapeFunc()
+def denseMemoized(shapeFunc):
+    return lambda func: arrayMemoized(func, shapeFunc)
+
+
+# Summary of one cache's usage
+def cacheStats(name, hits, misses, entries, nBytes, evictions):
+    calls = hits + misses
+    return {
+        'name': name,
+        'hits': hits,
+        'misses': misses,
+        'hitRate': (float(hits) / calls) if calls > 0 else None,
+        'entries': entries,
+        'bytes': nBytes,
+        'evictions': evictions,
+    }
+
+# Clear every cache, e.g. before processing the next trial.
+def clearAll():
+    for cache in CACHES:
+        cache.clear()
+
+# Usage stats for every cache that has been used.
+def stats():
+    return [cache.stats() for cache in CACHES if cache.hits + cache.misses > 0]
+
+# Usage stats for every cache used since stats() gave before: hits, misses and evictions
+# since then, with current entries and bytes.
+def statsSince(before):
+    previous = {cache['name']: cache for cache in before}
+    since = []
+    for cache in stats():
+        start = previous.get(cache['name'], {'hits': 0, 'misses': 0, 'evictions': 0})
+        hits, misses = cache['hits'] - start['hits'], cache['misses'] - start['misses']
+        if hits + misses > 0:
+            since.append(cacheStats(cache['name'], hits, misses, cache['entries'], cache['bytes'],
+                cache['evictions'] - start['evictions']))
+    return since
@@ -0,0 +1,304 @@
+"""
+Parallel scheduler for the all-pairs bivariate synchronization (BSL) matrix.
+First each channel's neighbourhoods are found once: its epsilon at every reference
+ point, and a bitset of which window points are within it (see synchro.neighbourBits).
+Then, as BSL(k, r) = BSL(r, k), only the upper triangle of channel pairs is counted,
+ in blocks spread across a process pool, by intersecting those bitsets, and mirrored.
+The signal and results are shared with the workers through shared memory, rather than
+ pickled over to each of them. The neighbourhoods are the largest part, so workers map
+ the checkpoint's file of them directly (in shared memory only without one on disk):
+ they're written once, then only read, and never all held in memory.
+"""
+
+import hashlib
+import math
+import multiprocessing
+import os
+import shutil
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+from tqdm import tqdm
+
+import profiler
+import synchro
+
+# Number of reference points a worker processes at once.
+REF_BLOCK = 64
+# Minimum time between checkpoint saves, in seconds.
+CHECKPOINT_SEC = 60
+
+# Per-process state: the shared arrays and derived values, set up by attachWorker.
+WORKER = {}
+
+
+class SharedArray(object):
+    '''
+    Numpy array backed by shared memory. Created by the parent process,
+    and attached to by workers using its spec().
+    '''
+    def __init__(self, shape, dtype=np.float64, name=None):
+        self.shape, self.dtype = tuple(shape), np.dtype(dtype)
+        self.owner = name is None
+        nBytes = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=nBytes if self.owner else 0)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    def spec(self):
+        return (self.shm.name, self.shape, self.dtype.str)
+
+    @classmethod
+    def attach(cls, spec):
+        name, shape, dtype = spec
+        return cls(shape, dtype, name=name)
+
+    def close(self):
+        self.array = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class Checkpoint(object):
+    '''
+    Partial results of parallelBSLs, kept on disk as neighbourhood and pair blocks finish,
+    so that an interrupted run can pick up where it left off. Saved results are only
+    reused for the exact same signal and parameters. A None path keeps nothing on disk,
+    only the pair counts: parallelBSLs then keeps the neighbourhoods in shared memory.
+    The path is a directory of memory-mapped .npy files, one per array, which the workers
+    write finished blocks into in place: saving only flushes the pages that changed, and
+    the arrays aren't held in memory as well. The small done flags are replaced atomically
+    after each flush, so they never claim data that hasn't reached the disk.
+    '''
+    def __init__(self, path, signal, params):
+        M, N = signal.shape
+        nRefs = len(synchro.referencePoints(N, N - (params.d - 1) * params.T, params.W2, params.Q))
+        self.path = path
+        self.key = checkpointKey(signal, params)
+        nWords = synchro.bitWords(len(synchro.windowOffsets(params.W1, params.W2)))
+        self.shapes = {
+            'neighbours': ((M, nRefs, nWords), np.dtype('<u8')),
+            'counts': ((M, M), np.float64),
+        }
+        self.epsilonsDone, self.countsDone = np.zeros(M, dtype=bool), np.zeros((M, M), dtype=bool)
+        self.lastSave = time.time()
+        if path is None:
+            self.neighbours = None
+            self.counts = np.zeros(*self.shapes['counts'])
+        elif not self.load():
+            self.create()
+
+    def file(self, field):
+        return os.path.join(self.path, field + '.npy')
+
+    def load(self):
+        '''Open the arrays saved at path, if they are for this signal. Returns whether they were.'''
+        if not os.path.exists(self.file('key')):
+            return False
+        if str(np.load(self.file('key'))) != self.key:
+            print("Ignoring checkpoint %s, it is for a different signal or parameters" % self.path)
+            return False
+        for field in self.shapes:
+            setattr(self, field, np.load(self.file(field), mmap_mode='r+'))
+        with np.load(self.file('done') + '.npz') as done:
+            self.epsilonsDone, self.countsDone = done['epsilonsDone'], done['countsDone']
+        print("Resuming from %s, %d / %d pairs done" % (
+            self.path, np.count_nonzero(np.triu(self.countsDone)), self.counts.shape[0] * (self.counts.shape[0] + 1) // 2))
+        return True
+
+    def create(self):
+        '''Start a new checkpoint at path, replacing any there.'''
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.makedirs(self.path)
+        for field, (shape, dtype) in self.shapes.items():
+            setattr(self, field, np.lib.format.open_memmap(self.file(field), mode='w+', dtype=dtype, shape=shape))
+        self.save(force=True)
+        np.save(self.file('key'), self.key) # Last, so a half-made checkpoint is never loaded.
+
+    def save(self, force=False):
+        '''Flush finished blocks to disk, at most once every CHECKPOINT_SEC unless forced.'''
+        if self.path is None or (not force and time.time() - self.lastSave < CHECKPOINT_SEC):
+            return
+        for field in self.shapes:
+            getattr(self, field).flush()
+        tmpPath = self.file('done') + '.tmp.npz'
+        np.savez(tmpPath, epsilonsDone=self.epsilonsDone, countsDone=self.countsDone)
+        os.replace(tmpPath, self.file('done') + '.npz') # Atomic, so a crash mid-save keeps the last flags.
+        self.lastSave = time.time()
+
+    # Workers have written the neighbourhoods of these channels into the neighbours file.
+    def neighboursFinished(self, channels):
+        self.epsilonsDone[channels] = True
+        self.save()
+
+    def countsFinished(self, rows, cols, counts):
+        self.counts[rows, cols] = counts[rows, cols]
+        self.countsDone[rows, cols] = True
+        self.save()
+
+    def remove(self):
+        if self.path is not None and os.path.exists(self.path):
+            for field in self.shapes:
+                setattr(self, field, None) # Release the memory maps first.
+            shutil.rmtree(self.path)
+
+# Identifies the signal & parameters a checkpoint is for.
+def checkpointKey(signal, params):
+    digest = hashlib.sha1(np.ascontiguousarray(signal).tobytes())
+    digest.update(repr((signal.shape, tuple(params))).encode('utf-8'))
+    return digest.hexdigest()
+
+
+# Pool initializer: attach to the shared arrays and build the embedding once per process.
+# The neighbourhoods are at neighbourSource, see workerNeighbours.
+def attachWorker(signalSpec, neighbourSource, resultSpec, params):
+    detachWorker()
+    signal = SharedArray.attach(signalSpec)
+    WORKER['shared'] = [signal, SharedArray.attach(resultSpec)]
+    WORKER['result'] = WORKER['shared'][1].array
+    WORKER['neighbourSource'] = neighbourSource
+    WORKER['params'] = params
+    WORKER['embedded'] = synchro.embed(signal.array, params.d, params.T)
+    WORKER['offsets'] = synchro.windowOffsets(params.W1, params.W2)
+    WORKER['refs'] = synchro.referencePoints(
+        signal.shape[1], WORKER['embedded'].shape[1], params.W2, params.Q)
+
+# This process' view of the neighbour bitsets (channels x reference points x words), from
+# ('file', path): mapped from the checkpoint's .npy, read-only unless writable, or ('shared', spec).
+def workerNeighbours(writable=False):
+    key = 'neighboursWritable' if writable else 'neighbours'
+    if key not in WORKER:
+        kind, where = WORKER['neighbourSource']
+        if kind == 'file':
+            WORKER[key] = np.load(where, mmap_mode='r+' if writable else 'r')
+        else:
+            shared = SharedArray.attach(where)
+            WORKER['shared'].append(shared)
+            WORKER[key] = shared.array
+    return WORKER[key]
+
+# Release this process' views of the shared arrays.
+def detachWorker():
+    for shared in WORKER.pop('shared', []):
+        shared.close()
+    WORKER.clear()
+
+# Reference point blocks, as (start, end) indexes into the reference points
+def refBlocks(nRefs):
+    return [(at, min(at + REF_BLOCK, nRefs)) for at in range(0, nRefs, REF_BLOCK)]
+
+# Window distances for channel k, for each reference point in a block (n x m).
+# Always done one channel at a time, so results don't depend on how channels are grouped.
+def channelDistances(k, ns):
+    return synchro.blockDistances(WORKER['embedded'][k:k+1], ns, WORKER['offsets'])[0]
+
+# Worker task: for a range of channels, find E_k,n and so the neighbour bitset for all reference points.
+def epsilonTask(channels):
+    pRef = WORKER['params'].pRef
+    neighbours = workerNeighbours(writable=True)
+    for start, end in refBlocks(len(WORKER['refs'])):
+        ns = WORKER['refs'][start:end]
+        for k in range(channels.start, channels.stop):
+            distances = channelDistances(k, ns)
+            neighbours[k, start:end] = synchro.neighbourBits(distances, synchro.epsilons(distances, pRef))
+    if isinstance(neighbours, np.memmap):
+        neighbours.flush() # On disk before the checkpoint marks them done.
+    return channels
+
+# Worker task: count points close in both k and r, for all k in rows and r in cols,
+# by intersecting their neighbour bitsets over all reference points.
+def pairTask(rowsAndCols):
+    rows, cols = rowsAndCols
+    neighbours = workerNeighbours()
+    WORKER['result'][rows, cols] = synchro.sharedNeighbourCounts(neighbours[rows], neighbours[cols])
+    return rowsAndCols
+
+# Split M channels into (at most) nGroups contiguous ranges
+def channelGroups(M, nGroups):
+    bounds = np.linspace(0, M, nGroups + 1).astype(int)
+    return [slice(bounds[i], bounds[i + 1]) for i in range(nGroups) if bounds[i] < bounds[i + 1]]
+
+# All (rows, cols) channel group blocks on or above the diagonal.
+def upperBlocks(M, nGroups):
+    groups = channelGroups(M, nGroups)
+    return [(groups[i], groups[j]) for i in range(len(groups)) for j in range(i, len(groups))]
+
+# Fewest channel groups giving at least one upper triangle block per process.
+def groupsFor(M, nProcesses):
+    return min(M, int(math.ceil((math.sqrt(1 + 8 * nProcesses) - 1) / 2)))
+
+# Run tasks over a pool if given, otherwise in this process, with a progress bar.
+# onDone is called with each task's result as it finishes.
+def runTasks(pool, task, args, desc, onDone):
+    results = pool.imap_unordered(task, args) if pool is not None else map(task, args)
+    for result in tqdm(results, total=len(args), desc=desc):
+        onDone(result)
+
+def parallelBSLs(signal, params, nProcesses=None, checkpoint=None):
+    """
+    Calculate BSL(k, r) for all channel pairs (k x r) of a (k channels x n samples) signal,
+    given its synchro.SyncParams, using nProcesses worker processes (default: all cores).
+    With nProcesses = 1, everything runs in this process.
+    If given a Checkpoint, work it already has is skipped, and new work is saved to it.
+    """
+    M, N = signal.shape
+    nProcesses = nProcesses or multiprocessing.cpu_count()
+    if checkpoint is None:
+        checkpoint = Checkpoint(None, signal, params)
+    neighbourShape, neighbourType = checkpoint.shapes['neighbours']
+    nRefs = neighbourShape[1]
+
+    shared = [SharedArray((M, N)), SharedArray((M, M))]
+    try:
+        shared[0].array[:] = signal
+        shared[1].array[:] = checkpoint.counts
+        if checkpoint.path is None:
+            shared.append(SharedArray(neighbourShape, neighbourType))
+            neighbourSource = ('shared', shared[-1].spec())
+        else:
+            neighbourSource = ('file', checkpoint.file('neighbours'))
+        initArgs = (shared[0].spec(), neighbourSource, shared[1].spec(), params)
+        channelTasks = [channels
+            for channels in channelGroups(M, min(M, nProcesses * 4))
+            if not checkpoint.epsilonsDone[channels].all()]
+        pairTasks = [(rows, cols)
+            for rows, cols in upperBlocks(M, groupsFor(M, nProcesses))
+            if not checkpoint.countsDone[rows, cols].all()]
+        # What the checkpoint saved redoing, for the profile report.
+        channelsComputed = sum(len(range(M)[channels]) for channels in channelTasks)
+        profiler.note(checkpoint={
+            'channelsResumed': M - channelsComputed,
+            'channelsComputed': channelsComputed,
+            'pairBlocksResumed': len(upperBlocks(M, groupsFor(M, nProcesses))) - len(pairTasks),
+            'pairBlocksComputed': len(pairTasks),
+        })
+        onEpsilons = checkpoint.neighboursFinished
+        onCounts = lambda rowsAndCols: checkpoint.countsFinished(rowsAndCols[0], rowsAndCols[1], shared[1].array)
+
+        if nProcesses == 1:
+            attachWorker(*initArgs)
+            try:
+                with profiler.span('neighbourhoods'):
+                    runTasks(None, epsilonTask, channelTasks, 'Neighbourhoods', onEpsilons)
+                with profiler.span('pairs'):
+                    runTasks(None, pairTask, pairTasks, 'Pair blocks', onCounts)
+            finally:
+                detachWorker()
+        else:
+            with multiprocessing.Pool(nProcesses, initializer=attachWorker, initargs=initArgs) as pool:
+                with profiler.span('neighbourhoods'):
+                    runTasks(pool, epsilonTask, channelTasks, 'Neighbourhoods', onEpsilons)
+                with profiler.span('pairs'):
+                    runTasks(pool, pairTask, pairTasks, 'Pair blocks', onCounts)
+                pool.close()
+                pool.join()
+        counts = shared[1].array.copy()
+    finally:
+        for s in shared:
+            s.close()
+
+    # Mirror the upper triangle into the lower.
+    counts = np.triu(counts) + np.triu(counts, 1).T
+    return synchro.syncScale(params) * counts / nRefs
@@ -0,0 +1,287 @@
+"""
+Lightweight instrumentation of the analysis stages: timed spans, peak memory, and cache hit rates.
+Stages are wrapped in `with profiler.span('stft'):`, within `with profiler.trial(name):` for the
+ trial being processed. Spans nest, and are totalled by their path (e.g. 'bandPowers/stft'),
+ so a span entered once per block adds up its calls. While a trial is open, a background
+ thread samples the resident memory every SAMPLE_SEC, giving each span's peak.
+When the trial closes, a JSON report is written to REPORT_DIR: each span's calls, seconds and
+ peak / change in memory, the hit rates of the caches used during the trial (memo.statsSince)
+ and any extra fields given, e.g. the work pairScheduler resumed from a checkpoint.
+ Reports are named by trial and time, so runs can be compared (run this file on two of them).
+Only the process that opened the trial is measured, not pool workers it hands work to, unless
+ they collect() their own spans and send them back for the trial to add (as run.py's chunks do).
+
+Off unless ENABLED (or the PROFILE environment variable) is set: span and trial then return a
+ shared do-nothing context, so instrumented code costs one check per stage.
+"""
+
+import argparse
+import collections
+import json
+import os
+import threading
+import time
+
+import memo
+
+try:
+    import resource
+except ImportError: # Not on Windows.
+    resource = None
+
+# Whether to measure anything. Set PROFILE=1 to turn on without editing code.
+ENABLED = bool(os.environ.get('PROFILE'))
+# Where per-trial reports are written.
+REPORT_DIR = os.environ.get('PROFILE_DIR', 'output/profile/')
+# Seconds between memory samples while a trial is open.
+SAMPLE_SEC = 0.02
+
+# The trial being measured, if any.
+CURRENT = None
+
+
+# Resident memory of this process in bytes, or None if it can't be measured here.
+def currentRSS():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is None:
+        return None
+    # The high water mark instead: kilobytes on Linux, bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+# Peak resident memory of this process and its finished children, in bytes, from the OS.
+def peakRSS():
+    if resource is None:
+        return {}
+    scale = 1 if os.uname().sysname == 'Darwin' else 1024
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+    }
+
+
+class NullSpan(object):
+    '''Context that does nothing, used for everything while profiling is off.'''
+    def __enter__(self):
+        return self
+    def __exit__(self, excType, excValue, traceback):
+        return False
+    def measured(self):
+        return None
+
+NULL_SPAN = NullSpan()
+
+
+class Span(object):
+    '''One entry into a stage of the open trial. Its totals are added to the trial's on exit.'''
+    def __init__(self, trial, name):
+        self.trial = trial
+        self.name = name
+
+    def __enter__(self):
+        # Paths leave out the trial's own span, which is always first.
+        self.path = '/'.join([span.name for span in self.trial.stack[1:]] + [self.name])
+        self.startRSS = currentRSS()
+        self.peak = self.startRSS
+        self.trial.stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        elapsed = time.perf_counter() - self.start
+        endRSS = currentRSS()
+        self.sample(endRSS)
+        self.trial.stack.pop()
+        self.trial.finished(self, elapsed, endRSS)
+        return False
+
+    def sample(self, rss):
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+
+
+class Trial(object):
+    '''
+    Spans measured while processing one trial, written as a report when it ends (unless
+    nameless, see collect). Also a span itself, covering the whole trial.
+    '''
+    def __init__(self, name, extra):
+        self.name = name
+        self.extra = extra
+        self.stack = []
+        self.totals = collections.OrderedDict()
+        self.addedCaches = []
+        self.lock = threading.Lock()
+        self.stopSampling = threading.Event()
+        self.reportPath = None
+
+    def __enter__(self):
+        global CURRENT
+        self.previous, CURRENT = CURRENT, self
+        self.started = time.time()
+        self.cachesBefore = memo.stats()
+        self.whole = Span(self, 'total').__enter__()
+        self.sampler = threading.Thread(target=self.sampleLoop, daemon=True)
+        self.sampler.start()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        global CURRENT
+        self.whole.__exit__(excType, excValue, traceback)
+        self.stopSampling.set()
+        self.sampler.join()
+        CURRENT = self.previous
+        self.caches = memo.statsSince(self.cachesBefore)
+        if excType is None and self.name is not None:
+            self.reportPath = writeReport(self.report())
+        return False
+
+    def sampleLoop(self):
+        while not self.stopSampling.wait(SAMPLE_SEC):
+            rss = currentRSS()
+            with self.lock:
+                for span in list(self.stack):
+                    span.sample(rss)
+
+    def finished(self, span, elapsed, endRSS):
+        rssChange = endRSS - span.startRSS if endRSS is not None and span.startRSS is not None else 0
+        with self.lock:
+            self.addTotal(span.path, 1, elapsed, span.peak, rssChange)
+
+    # Add calls to the span at path. Call with the lock held.
+    def addTotal(self, path, calls, seconds, peakRSS, rssChange):
+        total = self.totals.setdefault(path, {
+            'calls': 0, 'seconds': 0., 'peakRSS': None, 'rssChange': 0})
+        total['calls'] += calls
+        total['seconds'] += seconds
+        if peakRSS is not None:
+            total['peakRSS'] = max(total['peakRSS'] or 0, peakRSS)
+        total['rssChange'] += rssChange
+
+    def add(self, measured, under):
+        '''Add the spans and cache use another Trial measured (see collect) to this one's, at path under.'''
+        with self.lock:
+            for path, total in measured['spans'].items():
+                path = under if path == 'total' else '/'.join(filter(None, (under, path)))
+                if path:
+                    self.addTotal(path, total['calls'], total['seconds'], total['peakRSS'], total['rssChange'])
+        self.addedCaches.extend(measured['caches'])
+
+    # The spans and cache use measured, for add. Only once closed.
+    def measured(self):
+        return {'spans': self.totals, 'caches': self.caches}
+
+    def report(self):
+        return {
+            'trial': self.name,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'seconds': self.totals['total']['seconds'],
+            'peakRSS': peakRSS(),
+            'spans': [dict(path=path, **total) for path, total in self.totals.items()],
+            'caches': combineCaches(self.caches + self.addedCaches),
+            'extra': self.extra,
+        }
+
+
+def span(name):
+    """
+    Time a stage of the open trial: `with profiler.span('name'):`. Does nothing if profiling
+    is off, or no trial is open (e.g. in a pool worker).
+    """
+    if CURRENT is None:
+        return NULL_SPAN
+    return Span(CURRENT, name)
+
+def trial(name, **extra):
+    """
+    Measure the processing of one trial: `with profiler.trial(path):`, writing its report at
+    the end, with any extra keyword fields (e.g. sample rate) added. Inside another trial, spans
+    and fields are added to that one instead. Does nothing if profiling is off.
+    """
+    if not ENABLED:
+        return NULL_SPAN
+    if CURRENT is not None:
+        note(**extra)
+        return NULL_SPAN
+    return Trial(name, extra)
+
+def collect():
+    """
+    Measure spans away from the trial they're part of, e.g. in a pool worker, without writing a
+    report: `with profiler.collect() as part:`, then send part.measured() to the trial's process
+    to add. Does nothing if profiling is off, measured() then being None.
+    """
+    if not ENABLED:
+        return NULL_SPAN
+    return Trial(None, {})
+
+def add(measured, under=None):
+    """
+    Add what a collect() measured to the open trial, within the current span: as a span named
+    under, its spans inside that, or its spans at the current level if under is None.
+    """
+    if CURRENT is None or measured is None:
+        return
+    path = '/'.join([span.name for span in CURRENT.stack[1:]] + ([under] if under else []))
+    CURRENT.add(measured, path)
+
+# Combine cache stats (from memo.statsSince) for the same caches, e.g. in different processes:
+# hits, misses and evictions summed, entries and bytes the most any had.
+def combineCaches(caches):
+    combined = collections.OrderedDict()
+    for cache in caches:
+        if cache['name'] not in combined:
+            combined[cache['name']] = cache
+            continue
+        was = combined[cache['name']]
+        combined[cache['name']] = memo.cacheStats(cache['name'], was['hits'] + cache['hits'],
+            was['misses'] + cache['misses'], max(was['entries'], cache['entries']),
+            max(was['bytes'], cache['bytes']), was['evictions'] + cache['evictions'])
+    return list(combined.values())
+
+# Add fields to the open trial's report, e.g. values only known part way through.
+def note(**extra):
+    if CURRENT is not None:
+        CURRENT.extra.update(extra)
+
+# Write a trial report to REPORT_DIR, named by trial and start time. Returns its path.
+def writeReport(report):
+    if not os.path.exists(REPORT_DIR):
+        os.makedirs(REPORT_DIR)
+    name = '%s_%s' % (os.path.splitext(os.path.basename(report['trial']))[0], report['started'].replace(':', ''))
+    path, copy = os.path.join(REPORT_DIR, name + '.json'), 1
+    while os.path.exists(path): # Same trial started within the same second.
+        copy += 1
+        path = os.path.join(REPORT_DIR, '%s_%d.json' % (name, copy))
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1, default=str)
+    return path
+
+def loadReport(path):
+    with open(path) as f:
+        return json.load(f)
+
+# Print the spans of two reports side by side: seconds, and peak memory in MB.
+def compareReports(before, after):
+    spansBefore = {s['path']: s for s in before['spans']}
+    spansAfter = {s['path']: s for s in after['spans']}
+    paths = list(spansBefore) + [path for path in spansAfter if path not in spansBefore]
+    megabytes = lambda s: s['peakRSS'] / 1e6 if s.get('peakRSS') is not None else float('nan')
+    print("%-40s %10s %10s %8s %10s %10s" % ('span', 'sec before', 'sec after', 'ratio', 'MB before', 'MB after'))
+    for path in paths:
+        a, b = spansBefore.get(path), spansAfter.get(path)
+        secA, secB = a['seconds'] if a else float('nan'), b['seconds'] if b else float('nan')
+        ratio = secB / secA if a and b and secA > 0 else float('nan')
+        print("%-40s %10.3f %10.3f %8.2f %10.1f %10.1f" % (path, secA, secB, ratio,
+            megabytes(a) if a else float('nan'), megabytes(b) if b else float('nan')))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare two trial reports")
+    parser.add_argument('before')
+    parser.add_argument('after')
+    args = parser.parse_args()
+    compareReports(loadReport(args.before), loadReport(args.after))
@@ -1,13 +1,17 @@
 import matplotlib.pyplot as plt
-import mne.io
 import numpy as np
-import numpy.linalg
-import scipy.signal
-import mne.time_frequency
 
-from multiprocessing import Pool
+import multiprocessing
+import time
 
+import bandPower
+import decimate
+import loader
+import memo
+import profiler
+import spectral
 import viz
+from pairScheduler import SharedArray
 
 # >>> Parameters
 
@@ -20,66 +24,236 @@ START_TIME_SEC = 1 * 60
 END_TIME_SEC = 4.5 * 60
 
 # Which frequency bands we want to calculate average power for.
+# Any number can be added (e.g. 'delta': [0.5, 3.5], or sub-bands), at little extra cost.
 BAND_FREQUENCIES = {
     'theta': [3.5, 7.5],
     'alpha': [7.5, 13.0],
     'beta': [13.0, 30.0],
 }
 
+# Ratios between bands to calculate too, as ratio ID -> (numerator band, denominator band).
+BAND_RATIOS = {
+    'tbr': ('theta', 'beta'),
+}
+
+# Number of frames each band power is averaged over, 1 for no smoothing.
+SMOOTHING_FRAMES = 10
+
+# Whether to calculate band powers a block of frames at a time, reading each block from the
+# edf as needed and spreading a trial's blocks over the pool, rather than one trial per process
+# holding the whole recording and its spectrogram.
+STREAMING = True
+
+# Spectral estimate to take band powers from: 'stft', 'welch' or 'multitaper' (see spectral.py)
+SPECTRAL_BACKEND = 'stft'
+# Precision to calculate spectra in, 'float32' halves the memory traffic.
+SPECTRAL_DTYPE = 'float64'
+
+# Rate to decimate recordings to before calculating band powers (e.g. decimate.TARGET_RATE),
+# None for their full rate. STFT segments are shortened to match, keeping the same frequency bins.
+DECIMATE_TO_HZ = None
+
+# Frames of a trial each parallel task calculates, so long trials are spread over all processes.
+FRAMES_PER_TASK = bandPower.FRAMES_PER_BLOCK
+
 # Take a rolling average of the last n values in a
 def movingAverage(a, n=3) :
     ret = np.cumsum(a, dtype=float)
     ret[n:] = ret[n:] - ret[:-n]
     return ret[n - 1:] / n
 
-def calcBandPowers(raw):
-    data = raw._data
-    # Pick needed rows
-    if PICKS is not None:
-        pickIDs = mne.pick_types(raw.info, eeg=True, selection=PICKS)
-        data = np.take(data, pickIDs, axis=0)
-
-    # STFT for frequencies and powers
-    freq, t, stft = scipy.signal.stft(data, fs=int(raw.info['sfreq']))
-    powers = np.abs(stft)
-
-    result = {}
-    for bandID, bandHz in BAND_FREQUENCIES.iteritems():
-        # Find the average power for the frequencies in the band
-        fPick = np.logical_and(bandHz[0] < freq, freq < bandHz[1])
-        meanPower = np.mean(powers[:, fPick, :], axis=(0, 1))
-        result[bandID] = movingAverage(meanPower, 10)
+# Smooth the per-frame band powers, then add the BAND_RATIOS between them.
+def finishBandPowers(meanPowers):
+    result = {bandID: movingAverage(meanPower, SMOOTHING_FRAMES) if SMOOTHING_FRAMES > 1 else meanPower
+              for bandID, meanPower in meanPowers.items()}
+    result.update(bandPower.bandRatios(result, BAND_RATIOS))
     return result
 
+# Channel indexes to analyse, None for all.
+def pickedChannels(raw):
+    return loader.pickIDs(raw, PICKS) if PICKS is not None else None
+
+# Reader of the given channels of raw, decimated to DECIMATE_TO_HZ if set (see decimate.DecimatedReader),
+# and the STFT segment length giving frames as long in seconds as bandPower.NPERSEG at the full rate.
+def trialReader(raw, picks):
+    fullRate = raw.info['sfreq']
+    reader = decimate.DecimatedReader(lambda start, end: loader.readData(raw, picks, start, end),
+        raw.n_times, fullRate, DECIMATE_TO_HZ)
+    return reader, decimate.scaledLength(bandPower.NPERSEG, reader.sRate, fullRate)
+
+def calcBandPowers(raw):
+    # Read only the needed rows
+    with profiler.span('read'):
+        data = loader.readData(raw, pickedChannels(raw))
+    fullRate = raw.info['sfreq']
+    with profiler.span('decimate'):
+        data, fs = decimate.resample(data, fullRate, DECIMATE_TO_HZ)
+    nperseg = decimate.scaledLength(bandPower.NPERSEG, fs, fullRate)
+
+    # Spectrum for frequencies and powers
+    with profiler.span('spectra'):
+        freq, powers = spectral.spectrogram(data, fs, SPECTRAL_BACKEND, nperseg, dtype=SPECTRAL_DTYPE)
+
+    # Average power for the frequencies in each band, all at once
+    with profiler.span('bandMeans'):
+        return finishBandPowers(bandPower.bandMeans(powers, BAND_FREQUENCIES, fs, nperseg))
+
+# As calcBandPowers, but streamed through the recording block by block (see bandPower.py),
+# reading each block from raw as it goes.
+def calcBandPowersStreaming(raw):
+    picks = pickedChannels(raw)
+    nChannels = len(picks) if picks is not None else raw.info['nchan']
+    readSamples, nperseg = trialReader(raw, picks)
+
+    meanPowers = bandPower.streamBandPowers(readSamples, nChannels, readSamples.nSamples, readSamples.sRate,
+        BAND_FREQUENCIES, nperseg, backend=SPECTRAL_BACKEND, dtype=SPECTRAL_DTYPE)
+    return finishBandPowers(meanPowers)
+
 
 def bandStrength(pathAndBads):
     """
     Given an array [path, badChannels], load the data and return power data for each channel
     """
     path, bads = pathAndBads[0], pathAndBads[1]
-    raw = mne.io.read_raw_edf("data/" + path, preload=True)
-    raw = raw.crop(tmin=START_TIME_SEC, tmax=END_TIME_SEC)
-    raw.info['bads'] = bads
+    with profiler.trial(path, streaming=STREAMING, backend=SPECTRAL_BACKEND, dtype=SPECTRAL_DTYPE):
+        with profiler.span('open'):
+            raw = loader.openRaw(path, bads, START_TIME_SEC, END_TIME_SEC)
 
-    result = calcBandPowers(raw)
-    result['path'] = path
+        with profiler.span('bandPowers'):
+            result = calcBandPowersStreaming(raw) if STREAMING else calcBandPowers(raw)
+        result['path'] = path
+        result['sRate'] = decimate.effectiveRate(raw.info['sfreq'], DECIMATE_TO_HZ)
+        profiler.note(sRate=result['sRate'], samples=int(raw.n_times))
     return result
 
+# Worker task: bandStrength of one [path, badChannels], along with its index.
+def indexedBandStrength(trialAndPathAndBads):
+    trial, pathAndBads = trialAndPathAndBads
+    return trial, bandStrength(pathAndBads)
+
+
+# The open recording for a trial, kept by each worker process for the chunks that follow.
+@memo.boundedMemoized(maxEntries=2)
+def workerRaw(path, bads):
+    return loader.openRaw(path, list(bads), START_TIME_SEC, END_TIME_SEC, verbose=False)
+
+# Worker task: band powers for frames [frameStart, frameEnd) of one trial, written into
+# the trial's shared (bands x frames) output array rather than sent back.
+# Returns the trial, and what profiling measured of the chunk for its report (see profiler.collect).
+def bandChunkTask(task):
+    trial, path, bads, outSpec, frameStart, frameEnd = task
+    with profiler.collect() as chunk:
+        with profiler.span('open'):
+            raw = workerRaw(path, bads)
+        picks = pickedChannels(raw)
+        nChannels = len(picks) if picks is not None else raw.info['nchan']
+        readSamples, nperseg = trialReader(raw, picks)
+        out = SharedArray.attach(outSpec)
+        try:
+            bandPower.bandPowerFrames(readSamples, nChannels, readSamples.nSamples, readSamples.sRate,
+                BAND_FREQUENCIES, frameStart, frameEnd, dict(zip(BAND_FREQUENCIES, out.array)), nperseg,
+                backend=SPECTRAL_BACKEND, dtype=SPECTRAL_DTYPE)
+        finally:
+            out.close()
+    return trial, chunk.measured()
+
+
+class BandPowerExecutor(object):
+    '''
+    Process pool for calculating band powers of many trials, reusable across calls.
+    If STREAMING, each trial is split into chunks of frames, spread over the pool, with the
+    workers writing straight into shared memory. Every trial's chunks are queued up front, so
+    the pool never waits on the next trial; each trial's profile then covers waiting for its
+    chunks and assembling them, with the workers' own timings of the chunks added, and the
+    seconds from queueing them to the result.
+    Otherwise each worker calculates whole trials (see bandStrength). Use with 'with', so the
+    pool is shut down.
+    '''
+    def __init__(self, nProcesses=None):
+        self.nProcesses = nProcesses or multiprocessing.cpu_count()
+        self.pool = None
 
-def powerBandAnalysis(badMapping, nThreads=4):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if self.pool is None:
+            return
+        if excType is None:
+            self.pool.close()
+        else:
+            self.pool.terminate()
+        self.pool.join()
+        self.pool = None
+
+    def getPool(self):
+        # Started once shared memory has been made, so the workers share its cleanup tracking.
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.nProcesses)
+        return self.pool
+
+    def bandStrengths(self, pathsAndBads):
+        """
+        Given [path, badChannels] pairs, yield (index, result) as each trial finishes: in
+        order if STREAMING, otherwise in whatever order they do. Results are as bandStrength's.
+        """
+        if not STREAMING:
+            for trial, result in self.getPool().imap_unordered(indexedBandStrength, list(enumerate(pathsAndBads))):
+                yield trial, result
+            return
+        outputs, chunks, opened, queued, rates, samples = {}, {}, {}, {}, {}, {}
+        try:
+            for trial, (path, bads) in enumerate(pathsAndBads):
+                with profiler.collect() as opening:
+                    with profiler.span('open'):
+                        raw = loader.openRaw(path, bads, START_TIME_SEC, END_TIME_SEC, verbose=False)
+                opened[trial] = opening.measured()
+                readSamples, nperseg = trialReader(raw, None)
+                nFrames = bandPower.frameCount(readSamples.nSamples, nperseg)
+                rates[trial], samples[trial] = readSamples.sRate, int(raw.n_times)
+                outputs[trial] = SharedArray((len(BAND_FREQUENCIES), nFrames))
+                tasks = []
+                for frameStart in range(0, nFrames, FRAMES_PER_TASK):
+                    frameEnd = min(frameStart + FRAMES_PER_TASK, nFrames)
+                    tasks.append((trial, path, tuple(bads), outputs[trial].spec(), frameStart, frameEnd))
+                chunks[trial] = self.getPool().imap_unordered(bandChunkTask, tasks)
+                queued[trial] = time.perf_counter()
+
+            for trial, (path, bads) in enumerate(pathsAndBads):
+                with profiler.trial(path, streaming=STREAMING, backend=SPECTRAL_BACKEND, dtype=SPECTRAL_DTYPE):
+                    profiler.add(opened.pop(trial))
+                    with profiler.span('bandPowers'):
+                        for _, measured in chunks.pop(trial):
+                            profiler.add(measured, 'chunks')
+                        out = outputs.pop(trial)
+                        result = finishBandPowers(dict(zip(BAND_FREQUENCIES, out.array)))
+                        out.close()
+                    result['path'] = path
+                    result['sRate'] = rates[trial]
+                    profiler.note(sRate=result['sRate'], samples=samples[trial],
+                        secondsQueued=time.perf_counter() - queued[trial])
+                yield trial, result
+        finally:
+            for out in outputs.values():
+                out.close()
+
+
+def powerBandAnalysis(badMapping, nThreads=4, executor=None):
     """
     Given a mapping path -> list of bad channels for that data, load all the path
     and calculate the frequency power plots for all desired bands.
-    Does so multi-threaded to speed things up.
+    Does so in parallel to speed things up, plotting each trial as soon as it's done.
+    Pass a BandPowerExecutor to reuse its pool, otherwise one of nThreads processes is used.
     """
-    # Multithreaded mapping [path, bads] -> frequency powers
-    p = Pool(processes=nThreads)
+    if executor is None:
+        with BandPowerExecutor(nThreads) as executor:
+            return powerBandAnalysis(badMapping, executor=executor)
+
     badArray = []
-    for path, bads in badMapping.iteritems():
+    for path, bads in badMapping.items():
         badArray.append([path, bads])
     badArray = sorted(badArray, key=lambda x: x[0]) # Sort by path.
-    print badArray
-    results = p.map(bandStrength, badArray)
+    print(badArray)
 
     ax = viz.cleanSubplots(2, 3)
     ax[0, 0].set_title('log(Theta power)')
@@ -89,26 +263,28 @@ def powerBandAnalysis(badMapping, nThreads=4):
     ax[1, 1].set_title('Distribution of log(Beta)')
     ax[1, 2].set_title('Distribution of log(T/B)')
 
-    for i, result in enumerate(results):
+    longest = 0
+    for i, result in executor.bandStrengths(badArray):
         dot = '-' if i % 2 == 0 else '--' # line for Focus, dash for rest
         col = [(1,0,0), (0, 1, 0), (0, 0, 1), (.9, .7, 0), (.5, 0, .5), (0, .5, .5)][i // 2] # One colour per person
-        t, b = result['theta'], result['beta']
-        if i == 0:
-            lt = len(t)
+        t, b, tbr = result['theta'], result['beta'], result['tbr']
+        if len(t) > longest:
+            longest = len(t)
             ax[0,0].set_xlim([0, len(t)])
             ax[0,1].set_xlim([0, len(t)])
             ax[0,2].set_xlim([0, len(t)])
 
         ax[0, 0].plot(np.log(t), c=col, ls=dot)
         ax[0, 1].plot(np.log(b), c=col, ls=dot)
-        ax[0, 2].plot(np.log(t / b), c=col, ls=dot)
+        ax[0, 2].plot(np.log(tbr), c=col, ls=dot)
         # TBR distribution
-        hist, edges = np.histogram(np.log(t), normed=True)
+        hist, edges = np.histogram(np.log(t), density=True)
         ax[1, 0].plot(movingAverage(edges, 2), hist, c=col, ls=dot, label=viz.shortName(result['path']))
-        hist, edges = np.histogram(np.log(b), normed=True)
+        hist, edges = np.histogram(np.log(b), density=True)
         ax[1, 1].plot(movingAverage(edges, 2), hist, c=col, ls=dot)
-        hist, edges = np.histogram(np.log(t / b), normed=True)
+        hist, edges = np.histogram(np.log(tbr), density=True)
         ax[1, 2].plot(movingAverage(edges, 2), hist, c=col, ls=dot)
+        plt.pause(0.001) # Show each trial as it comes in
 
     ax[1, 0].legend()
     plt.show()
@@ -116,17 +292,6 @@ def powerBandAnalysis(badMapping, nThreads=4):
 
 if __name__ == '__main__':
     # """
-    powerBandAnalysis({
-        'T013_D001_V00_2017_05_16_Emily-Resting-30Hzfilt.edf': ['STI 014', 'EEG 55', 'EEG VREF'],
-        'T013_D002_V00_2017_05_16_Emily-Focus-30Hzfilt.edf': ['STI 014', 'EEG 55', 'EEG VREF'],
-        'T013_D003_V00_2017_05_16_Giulio-Resting-State-30Hzfilt.edf': ['STI 014', 'EEG 10', 'EEG 63', 'EEG VREF'],
-        'T013_D004_V00_2017_05_16_Giulio-Focused-30Hzfilt.edf': ['STI 014', 'EEG 10', 'EEG 63', 'EEG VREF'],
-        'T013_D005_V00_2017_05_15_Patrick-Resting-State-30Hzfilt.edf': ['STI 014', 'EEG 10', 'EEG 63', 'EEG VREF'],
-        'T013_D006_V00_2017_05_15_Patrick-Focus-30Hzfilt.edf': ['STI 014', 'EEG 10', 'EEG 63', 'EEG VREF'],
-        'T013_D007_V00_2017_05_16_MichaelH-Resting-State-30Hzfilt.edf': ['STI 014', 'EEG 10', 'EEG 63', 'EEG VREF'],
-        'T013_D008_V00_2017_05_16_MichaelH-Focus-30Hzfilt.edf': ['STI 014', 'EEG 10', 'EEG 63', 'EEG VREF'],
-        'T013_D009_V00_2017_05_15_Yana-Resting-State-30Hzfilt.edf': ['STI 014', 'EEG 18', 'EEG 23', 'EEG 46', 'EEG 56', 'EEG VREF'],
-        'T013_D010_V00_2017_05_15_Yana-Focus-30Hzfilt.edf': ['STI 014', 'EEG 18', 'EEG 56', 'EEG VREF'],
-    }, nThreads=8)
+    powerBandAnalysis(loader.BAD_CHANNELS, nThreads=8)
     # """
     # viz.showEdfSignal('data/T013_D006_V00_2017_05_15_Patrick-Focus-30Hzfilt.edf') # Use this to pick bad channels above.
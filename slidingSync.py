@@ -0,0 +1,116 @@
+"""
+Time-resolved bivariate synchronization: BSL(k, r) over a window of reference points
+ that slides along the signal one reference point (Q samples) at a time, giving an
+ (M x M x T) array of synchronization through the session rather than one matrix.
+Each reference point's pair counts are found once, from its neighbour bitsets
+ (see synchro.neighbourBits), then the window's totals are updated incrementally:
+ adding the counts of the point entering the window and removing those of the one
+ leaving it. So the whole series costs about the same as the single averaged BSL,
+ which comes out of the same pass.
+slidingBSLs does everything in one process. For long trials, waveletGenerator finds the
+ bitsets with pairScheduler instead (in parallel, and checkpointed), then only the window
+ totals are left for slidingFromNeighbours.
+"""
+
+import collections
+
+import numpy as np
+from tqdm import tqdm
+
+import synchro
+
+# Reference points found at once, per channel.
+REF_BLOCK = 64
+
+
+class SlidingPairCounts(object):
+    '''
+    Running totals of pair counts (M x M) over the last windowRefs reference points.
+    Counts are integers, so adding and removing them never drifts.
+    '''
+    def __init__(self, M, windowRefs):
+        self.windowRefs = windowRefs
+        self.window = collections.deque()
+        self.total = np.zeros((M, M), dtype=np.int64)
+
+    def add(self, counts):
+        '''Add the counts of the newest reference point, dropping the oldest if the window is full.'''
+        self.window.append(counts)
+        self.total += counts
+        if len(self.window) > self.windowRefs:
+            self.total -= self.window.popleft()
+
+    def full(self):
+        return len(self.window) == self.windowRefs
+
+    def bsls(self, scale):
+        '''BSL for all pairs over the reference points in the window.'''
+        return scale * self.total / len(self.window)
+
+# Pair counts (M x M) at a single reference point, from its neighbour bitsets (M x words).
+def pointPairCounts(bits):
+    return synchro.popcount(bits[:, None, :] & bits[None, :, :]).sum(axis=-1).astype(np.int64)
+
+# Neighbour bitsets (M x n x words) for a block of reference points ns, one channel at a time.
+def blockNeighbours(embedded, ns, offsets, pRef):
+    bits = []
+    for k in range(embedded.shape[0]):
+        distances = synchro.blockDistances(embedded[k:k+1], ns, offsets)[0]
+        bits.append(synchro.neighbourBits(distances, synchro.epsilons(distances, pRef)))
+    return np.array(bits)
+
+# Sample at the middle of each output window, for labelling the time axis.
+def windowCentres(refs, windowRefs):
+    return (refs[:len(refs) - windowRefs + 1] + refs[windowRefs - 1:]) / 2.
+
+def slidingBSLs(signal, params, windowRefs, out=None, dtype=np.float32):
+    """
+    BSL for all channel pairs of a (k channels x n samples) signal, over each run of
+    windowRefs consecutive reference points, for every position of that window.
+    Written into out (e.g. a memory-mapped array) if given, which should be
+    (M x M x T), T = number of reference points - windowRefs + 1.
+    Returns (out, BSL over all reference points, the reference points)
+    """
+    M, N = signal.shape
+    embedded = synchro.embed(signal, params.d, params.T)
+    offsets = synchro.windowOffsets(params.W1, params.W2)
+    refs = synchro.referencePoints(N, embedded.shape[1], params.W2, params.Q)
+    if len(refs) < windowRefs:
+        raise ValueError("Only %d reference points, fewer than the window of %d" % (len(refs), windowRefs))
+    if out is None:
+        out = np.zeros((M, M, len(refs) - windowRefs + 1), dtype=dtype)
+    scale = synchro.syncScale(params)
+
+    sliding = SlidingPairCounts(M, windowRefs)
+    overall = np.zeros((M, M), dtype=np.int64)
+    at = 0
+    for start in tqdm(range(0, len(refs), REF_BLOCK), desc='Sliding BSL'):
+        bits = blockNeighbours(embedded, refs[start:start + REF_BLOCK], offsets, params.pRef)
+        for i in range(bits.shape[1]):
+            counts = pointPairCounts(bits[:, i])
+            overall += counts
+            sliding.add(counts)
+            if sliding.full():
+                out[:, :, at] = sliding.bsls(scale)
+                at += 1
+    return out, scale * overall / len(refs), refs
+
+def slidingFromNeighbours(neighbours, windowRefs, scale, out):
+    """
+    As slidingBSLs, from neighbour bitsets already found for every reference point
+    (M x reference points x words, as pairScheduler.Checkpoint keeps them).
+    Writes each window position's BSLs into out, and returns it.
+    """
+    M, nRefs = neighbours.shape[:2]
+    if nRefs < windowRefs:
+        raise ValueError("Only %d reference points, fewer than the window of %d" % (nRefs, windowRefs))
+    sliding = SlidingPairCounts(M, windowRefs)
+    at = 0
+    for start in tqdm(range(0, nRefs, REF_BLOCK), desc='Sliding BSL'):
+        bits = np.asarray(neighbours[:, start:start + REF_BLOCK])
+        for i in range(bits.shape[1]):
+            sliding.add(pointPairCounts(bits[:, i]))
+            if sliding.full():
+                out[:, :, at] = sliding.bsls(scale)
+                at += 1
+    return out
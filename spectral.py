@@ -0,0 +1,182 @@
+"""
+Spectral estimates for band power analysis, over the same frames as scipy.signal.stft
+ (segments of nperseg, 50% overlap, zero padded boundaries) so they can be swapped freely:
+  stft       - |stft|, as scipy.signal.stft with its default hann window.
+  welch      - Welch PSD within each frame: half-length sub-segments, 50% overlapped, each
+               detrended (its mean removed) and hann windowed, periodograms averaged
+               (zero padded to the same bins). As scipy.signal.welch with its defaults.
+  multitaper - Multitaper PSD of each frame, averaged over DPSS tapers.
+Each is a set of tapers applied to the frame, so the setup (tapers, scaling, and the DFT bases
+ of the bins wanted) is built once per backend, sample rate, segment length and dtype, and
+ cached (see spectralPlan, planBases).
+scipy.fft keeps its own FFT plans per length, so those are reused across trials too.
+
+Run directly to compare the backends on a recording, for speed and agreement.
+"""
+
+import argparse
+import collections
+import time
+
+import numpy as np
+import scipy.fft
+import scipy.signal
+
+import memo
+
+BACKENDS = ('stft', 'welch', 'multitaper')
+# Time half bandwidth of the DPSS tapers, and number used.
+MULTITAPER_NW = 2.5
+MULTITAPER_TAPERS = 4
+# Welch sub-segments per frame, each half the frame's length.
+WELCH_SEGMENTS = 3
+
+SpectralPlan = collections.namedtuple('SpectralPlan', ['backend', 'fs', 'nperseg', 'dtype', 'tapers', 'binWeights', 'magnitude',
+    'detrendSpans'])
+
+# Sum of squares a one-sided spectrum needs, doubling all but the DC (and Nyquist) bins.
+def oneSidedWeights(nperseg):
+    weights = np.full(nperseg // 2 + 1, 2.)
+    weights[0] = 1.
+    if nperseg % 2 == 0:
+        weights[-1] = 1.
+    return weights
+
+@memo.memoized
+def spectralPlan(backend, fs, nperseg=256, dtype='float64'):
+    """
+    Tapers (each nperseg long) and per-bin weights for a backend. The spectrum of a frame
+    is |fft(frame * taper)| for the single stft taper, otherwise the sum over tapers of
+    |fft(frame * taper)|^2, times the bin weights. If there are detrendSpans, the frame's
+    mean over each taper's (start, end) span is subtracted before applying that taper.
+    """
+    detrendSpans = None
+    if backend == 'stft':
+        window = scipy.signal.get_window('hann', nperseg)
+        tapers = (window / window.sum())[None, :]
+        binWeights, magnitude = np.ones(nperseg // 2 + 1), True
+    elif backend == 'welch':
+        length = nperseg // 2
+        window = scipy.signal.get_window('hann', length)
+        starts = np.linspace(0, nperseg - length, WELCH_SEGMENTS).astype(int)
+        tapers = np.zeros((WELCH_SEGMENTS, nperseg))
+        for i, start in enumerate(starts):
+            tapers[i, start:start + length] = window
+        detrendSpans = tuple((int(start), int(start) + length) for start in starts)
+        # Density scaling as scipy.signal.welch, averaged over the sub-segments.
+        tapers /= np.sqrt(fs * (window * window).sum() * WELCH_SEGMENTS)
+        binWeights, magnitude = oneSidedWeights(nperseg), False
+    elif backend == 'multitaper':
+        tapers = scipy.signal.windows.dpss(nperseg, MULTITAPER_NW, MULTITAPER_TAPERS)
+        # Each taper has unit energy, so this is the density averaged over tapers.
+        tapers = tapers / np.sqrt(fs * MULTITAPER_TAPERS)
+        binWeights, magnitude = oneSidedWeights(nperseg), False
+    else:
+        raise ValueError("Unknown spectral backend %s, expected one of %s" % (backend, BACKENDS))
+    dtype = np.dtype(dtype)
+    return SpectralPlan(backend, fs, nperseg, dtype.name,
+        tapers.astype(dtype), binWeights.astype(dtype), magnitude, detrendSpans)
+
+# Spectra of (... x nperseg) segments, as (... x bins) for all nperseg // 2 + 1 bins.
+def frameSpectra(segments, plan):
+    segments = segments.astype(plan.dtype, copy=False)
+    if plan.magnitude:
+        return np.abs(scipy.fft.rfft(segments * plan.tapers[0], axis=-1))
+    result = 0
+    for i, taper in enumerate(plan.tapers):
+        if plan.detrendSpans is not None:
+            start, end = plan.detrendSpans[i]
+            spectrum = scipy.fft.rfft((segments - segments[..., start:end].mean(axis=-1, keepdims=True)) * taper, axis=-1)
+        else:
+            spectrum = scipy.fft.rfft(segments * taper, axis=-1)
+        result = result + (spectrum.real ** 2 + spectrum.imag ** 2)
+    return result * plan.binWeights
+
+# Real and imaginary DFT rows for just the given bins, per taper (tapers x bins x nperseg).
+# Detrending is linear too, so it's folded in: removing a span's mean from the frame is the
+# same as removing each row's mean over that span from the row.
+def dftBases(bins, plan):
+    phase = 2. * np.pi * np.outer(bins, np.arange(plan.nperseg)) / plan.nperseg
+    cosBases = np.cos(phase)[None] * plan.tapers[:, None, :]
+    sinBases = -np.sin(phase)[None] * plan.tapers[:, None, :]
+    for i, (start, end) in enumerate(plan.detrendSpans or ()):
+        for bases in (cosBases, sinBases):
+            bases[i, :, start:end] -= bases[i, :, start:end].mean(axis=-1, keepdims=True)
+    return cosBases.astype(plan.dtype), sinBases.astype(plan.dtype)
+
+# dftBases for spectralPlan(backend, fs, nperseg, dtype) and a tuple of bins, cached like the plan,
+# so they're built once per process rather than for every trial or chunk.
+@memo.memoized
+def planBases(backend, fs, nperseg, dtype, bins):
+    return dftBases(np.array(bins, dtype=int), spectralPlan(backend, fs, nperseg, dtype))
+
+# As frameSpectra, but only for the bins dftBases was given, using its bases.
+def binSpectra(segments, cosBases, sinBases, binWeights, plan):
+    segments = segments.astype(plan.dtype, copy=False)
+    if plan.magnitude:
+        return np.hypot(np.dot(segments, cosBases[0].T), np.dot(segments, sinBases[0].T))
+    result = 0
+    for cosBasis, sinBasis in zip(cosBases, sinBases):
+        real, imag = np.dot(segments, cosBasis.T), np.dot(segments, sinBasis.T)
+        result = result + (real * real + imag * imag)
+    return result * binWeights
+
+# Split a (channels x samples) signal into the stft's frames: zero padded by nperseg // 2
+# either side, and at the end to a whole frame. Returns a (channels x frames x nperseg) view.
+def frames(data, nperseg=256):
+    step, offset = nperseg - nperseg // 2, nperseg // 2
+    nChannels, nSamples = data.shape
+    padded = nSamples + 2 * offset
+    padded += (-(padded - nperseg) % step) % nperseg
+    nFrames = (padded - nperseg) // step + 1
+    block = np.zeros((nChannels, (nFrames - 1) * step + nperseg), dtype=data.dtype)
+    block[:, offset:offset + nSamples] = data
+    return np.lib.stride_tricks.as_strided(block, shape=(nChannels, nFrames, nperseg),
+        strides=(block.strides[0], block.strides[1] * step, block.strides[1]), writeable=False)
+
+def spectrogram(data, fs, backend='stft', nperseg=256, dtype='float64'):
+    """
+    Spectrum of each stft frame of a (channels x samples) signal, with the given backend.
+    Returns (bin frequencies, channels x bins x frames), laid out as scipy.signal.stft's.
+    """
+    plan = spectralPlan(backend, fs, nperseg, np.dtype(dtype).name)
+    spectra = frameSpectra(frames(np.asarray(data, dtype=plan.dtype), nperseg), plan)
+    return np.fft.rfftfreq(nperseg, 1. / fs), np.swapaxes(spectra, 1, 2)
+
+# Time each backend & dtype at calculating band powers for a signal, and how well their
+# log band powers correlate over time with the stft's in double precision.
+def benchmark(data, fs, bands, nperseg=256, repeats=5):
+    import bandPower
+    reference, results = None, []
+    for backend in BACKENDS:
+        for dtype in ['float64', 'float32']:
+            start = time.time()
+            spectralPlan(backend, fs, nperseg, dtype)
+            setup = time.time() - start
+            start = time.time()
+            for _ in range(repeats):
+                _, spectra = spectrogram(data, fs, backend, nperseg, dtype)
+                powers = bandPower.bandMeans(spectra, bands, fs, nperseg)
+            elapsed = (time.time() - start) / repeats
+            if reference is None:
+                reference = powers
+            agreement = {bandID: np.corrcoef(np.log(reference[bandID]), np.log(powers[bandID]))[0, 1]
+                         for bandID in bands}
+            results.append((backend, dtype, setup, elapsed, agreement))
+    return results
+
+if __name__ == '__main__':
+    import loader
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help="EDF to benchmark on, within data/")
+    parser.add_argument('--bads', nargs='*', default=['STI 014', 'EEG VREF'], help="Bad channels to leave out")
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    bands = {'theta': [3.5, 7.5], 'alpha': [7.5, 13.0], 'beta': [13.0, 30.0]}
+    data, names, sRate = loader.loadTrial(args.path, args.bads)
+    print("%d channels x %d samples at %dhz" % (data.shape[0], data.shape[1], sRate))
+    print("%-10s %-8s %9s %9s   %s" % ('backend', 'dtype', 'setup ms', 'run ms', 'correlation of log power with stft'))
+    for backend, dtype, setup, elapsed, agreement in benchmark(data, int(sRate), bands, repeats=args.repeats):
+        print("%-10s %-8s %9.2f %9.1f   %s" % (backend, dtype, setup * 1000, elapsed * 1000,
+            ", ".join("%s %.4f" % (bandID, r) for bandID, r in agreement.items())))
@@ -0,0 +1,130 @@
+"""
+Vectorized building blocks for the synchronization likelihood measures.
+Rather than comparing one pair of X vectors at a time, these work on the whole
+ delay-embedded signal, computing every window distance for a reference point
+ in one array operation, shared across all channels.
+Only depends on numpy, so it can be used both offline (waveletGenerator.py) and live.
+"""
+
+import collections
+
+import numpy as np
+
+# Parameters of the measures, as in waveletGenerator.py: embedding dimension d, lag T,
+# window W1 <= |m - n| < W2, probability cutoff pRef and reference point spacing Q.
+SyncParams = collections.namedtuple('SyncParams', ['d', 'T', 'W1', 'W2', 'pRef', 'Q'])
+
+# Normalization used by S and BS: 1 / (2 P_ref (W2 - W1))
+def syncScale(params):
+    return 1. / (2. * params.pRef * (params.W2 - params.W1))
+
+# Delay-embed a (k channels x n samples) signal into (k x n' x d) vectors.
+# Row [k, n] is X(k, n) from the paper. This is a strided view, no data is copied.
+def embed(signal, d, T):
+    signal = np.ascontiguousarray(signal)
+    M, N = signal.shape
+    nVectors = N - (d - 1) * T
+    strideK, strideN = signal.strides
+    return np.lib.stride_tricks.as_strided(signal,
+        shape=(M, nVectors, d), strides=(strideK, strideN, strideN * T), writeable=False)
+
+# Offsets (m - n) of all points in the window W1 <= |m - n| < W2, before then after n.
+def windowOffsets(W1, W2):
+    return np.concatenate((-np.arange(W1, W2), np.arange(W1, W2)))
+
+# Reference points n that get averaged over, every Q samples.
+# Stops early enough that every X in the window is fully inside the signal.
+def referencePoints(nSamples, nVectors, W2, Q):
+    return np.arange(W2, min(nSamples - W2 - 1, nVectors - W2 + 1), Q)
+
+# dist(X_k,m, X_k,n) for every channel k and every m in the window around n (k x m)
+def windowDistances(embedded, n, offsets):
+    diff = embedded[:, n + offsets, :] - embedded[:, n, None, :]
+    return np.sqrt(np.einsum('kmd,kmd->km', diff, diff))
+
+# As windowDistances, for a block of reference points ns at once (k x n x m)
+def blockDistances(embedded, ns, offsets):
+    diff = embedded[:, ns[:, None] + offsets, :] - embedded[:, ns, None, :]
+    return np.sqrt(np.einsum('knmd,knmd->knm', diff, diff))
+
+# For each channel k and window point m, whether dist(X_k,m, X_k,n) < E_k,n
+def closeMask(distances, epsilons):
+    return distances < np.asarray(epsilons)[:, None]
+
+# H_n,m for every window point m: number of channels where m is close to n
+def closeChannelCounts(close):
+    return np.count_nonzero(close, axis=0)
+
+# S_k,n for every channel k, given the close mask around n
+def channelSynchronization(close, scale):
+    M = close.shape[0]
+    weights = (closeChannelCounts(close) - 1.) / (M - 1.)
+    return scale * np.dot(close, weights)
+
+# Bits set in each byte value, for numpy versions without bitwise_count.
+BYTE_POPCOUNTS = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# Pack the last axis of a boolean array (e.g. a close mask) into uint64 bitsets,
+# bit m of the set being point m. Unused high bits of the last word are zero.
+def packBits(close):
+    packed = np.packbits(close, axis=-1, bitorder='little')
+    padding = -packed.shape[-1] % 8
+    if padding:
+        packed = np.concatenate((packed, np.zeros(packed.shape[:-1] + (padding,), dtype=np.uint8)), axis=-1)
+    return np.ascontiguousarray(packed).view('<u8')
+
+# Number of uint64 words packBits uses for m points.
+def bitWords(m):
+    return (m + 63) // 64
+
+# Number of bits set in each word.
+def popcount(words):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    return BYTE_POPCOUNTS[np.ascontiguousarray(words).view(np.uint8)].reshape(words.shape + (8,)).sum(axis=-1)
+
+# Neighbour bitsets: for each channel and reference point, which window points lie
+# within its epsilon (... x words), from the window distances (... x m).
+def neighbourBits(distances, epsilons):
+    return packBits(distances < np.asarray(epsilons)[..., None])
+
+# Whether window point m is in each neighbour bitset.
+def hasNeighbour(bits, m):
+    return (bits[..., m // 64] >> np.uint64(m % 64)) & np.uint64(1) == 1
+
+# Number of window points (over all n) close in both channel k and channel r, for all pairs (k x r),
+# from neighbour bitsets (k x n x words). Pairs are taken between bits and bitsOther if given.
+def sharedNeighbourCounts(bits, bitsOther=None):
+    other = bits if bitsOther is None else bitsOther
+    counts = np.zeros((bits.shape[0], other.shape[0]))
+    for i in range(bits.shape[0]):
+        counts[i] = popcount(bits[i][None] & other).reshape(other.shape[0], -1).sum(axis=1)
+    return counts
+
+# Number of close points needed for P(dist < e) >= pRef, out of windowSize points
+def closeCountNeeded(windowSize, pRef):
+    needed = max(int(np.ceil(pRef * windowSize)), 1)
+    # Same floating point comparison as the counting definition, to agree at the boundary.
+    while (1. / windowSize) * needed < pRef:
+        needed += 1
+    while needed > 1 and (1. / windowSize) * (needed - 1) >= pRef:
+        needed -= 1
+    return needed
+
+# E_k,n for every channel: the largest epsilon with P(dist(X_k,m, X_k,n) < epsilon) < pRef.
+# That is the distance to the c-th closest window point, c = closeCountNeeded.
+def epsilons(distances, pRef):
+    c = closeCountNeeded(distances.shape[-1], pRef)
+    return np.partition(distances, c - 1, axis=-1)[..., c - 1]
+
+# Save a synchronization matrix, with the channel names of its rows/columns and the
+# parameters & sample rate it was calculated with, as a single .npz
+def saveMatrix(path, matrix, channels, params, sRate):
+    np.savez(path, matrix=matrix, channels=np.array(channels, dtype=str),
+        sRate=sRate, **{field: value for field, value in params._asdict().items()})
+
+# Load a matrix saved by saveMatrix. Returns (matrix, channel names, SyncParams, sample rate)
+def loadMatrix(path):
+    with np.load(path) as saved:
+        params = SyncParams(*[saved[field].item() for field in SyncParams._fields])
+        return saved['matrix'], saved['channels'].tolist(), params, saved['sRate'].item()
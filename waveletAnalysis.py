@@ -3,9 +3,12 @@ Performs analysis on the synchronization output of waveletGenerator.py
 """
 
 import matplotlib.pyplot as plt
-import mne
 import numpy as np
+import os
 
+import loader
+import profiler
+import synchro
 import viz
 
 # Channels to include in the analysis:
@@ -27,19 +30,28 @@ def findIndexes(have, want):
 # Process a single trial's synchronization
 def analyzeOne(path, bads, person, type):
     print("Processing %s, %s" % (person, type))
-
-    # 1) Load edf to get channel names, convert to index
-    raw = mne.io.read_raw_edf("data/" + path, preload=True, verbose=False)
-    raw.info['bads'] = bads
-    processedChannels = mne.pick_types(raw.info, eeg=True, selection=None)
-    wantedChannels = mne.pick_types(raw.info, eeg=True, selection=PICKS)
-    indexes = findIndexes(processedChannels, wantedChannels)
-
-    # 2) Load synchronization data
     Q = 100 # Whatever was used by waveletGenerator
-    syncFile = "output/synchro/%s-%s_q=%d.csv" % (person, type, Q)
-    syncData = np.genfromtxt(syncFile, delimiter=', ')
-    syncData = syncData[indexes[:, None], indexes]
+
+    with profiler.trial(path, person=person, type=type):
+        syncFile = "output/synchro/%s-%s_q=%d.npz" % (person, type, Q)
+        if os.path.exists(syncFile):
+            # Channel names are saved with the data, keep those wanted in channel order as pick_types does.
+            with profiler.span('loadMatrix'):
+                syncData, channels, _, _ = synchro.loadMatrix(syncFile)
+            indexes = np.array([i for i, name in enumerate(channels) if name in PICKS])
+        else:
+            # Older CSV output: 1) Open edf header to get channel names, convert to index
+            with profiler.span('open'):
+                raw = loader.openRaw(path, bads, verbose=False)
+                processedChannels = loader.pickIDs(raw)
+                wantedChannels = loader.pickIDs(raw, PICKS)
+            indexes = findIndexes(processedChannels, wantedChannels)
+
+            # 2) Load synchronization data
+            syncFile = "output/synchro/%s-%s_q=%d.csv" % (person, type, Q)
+            with profiler.span('loadCSV'):
+                syncData = np.genfromtxt(syncFile, delimiter=', ')
+        syncData = syncData[indexes[:, None], indexes]
     return syncData
 
 # Analyze all trials, given EEG path and bad channels
@@ -47,7 +59,7 @@ def analyzeAll(badMapping):
     results = {}
 
     allMin, allMax = None, None
-    for path, bads in badMapping.iteritems():
+    for path, bads in badMapping.items():
         shortName = viz.shortName(path)
         [person, type] = shortName.split('-')
         if person not in results:
@@ -104,16 +116,5 @@ def displayResults(results, allMin, allMax):
 
 
 if __name__ == '__main__':
-    results, allMin, allMax = analyzeAll({
-        'T013_D001_V00_2017_05_16_Emily-Resting-30Hzfilt.edf': ['STI 014', 'EEG 55', 'EEG VREF'],
-        'T013_D002_V00_2017_05_16_Emily-Focus-30Hzfilt.edf': ['STI 014', 'EEG 55', 'EEG VREF'],
-        'T013_D003_V00_2017_05_16_Giulio-Resting-State-30Hzfilt.edf': ['STI 014', 'EEG 10', 'EEG 63', 'EEG VREF'],
-        'T013_D004_V00_2017_05_16_Giulio-Focused-30Hzfilt.edf': ['STI 014', 'EEG 10', 'EEG 63', 'EEG VREF'],
-        'T013_D005_V00_2017_05_15_Patrick-Resting-State-30Hzfilt.edf': ['STI 014', 'EEG 10', 'EEG 63', 'EEG VREF'],
-        'T013_D006_V00_2017_05_15_Patrick-Focus-30Hzfilt.edf': ['STI 014', 'EEG 10', 'EEG 63', 'EEG VREF'],
-        'T013_D007_V00_2017_05_16_MichaelH-Resting-State-30Hzfilt.edf': ['STI 014', 'EEG 10', 'EEG 63', 'EEG VREF'],
-        'T013_D008_V00_2017_05_16_MichaelH-Focus-30Hzfilt.edf': ['STI 014', 'EEG 10', 'EEG 63', 'EEG VREF'],
-        'T013_D009_V00_2017_05_15_Yana-Resting-State-30Hzfilt.edf': ['STI 014', 'EEG 18', 'EEG 23', 'EEG 46', 'EEG 56', 'EEG VREF'],
-        'T013_D010_V00_2017_05_15_Yana-Focus-30Hzfilt.edf': ['STI 014', 'EEG 18', 'EEG 56', 'EEG VREF'],
-    })
+    results, allMin, allMax = analyzeAll(loader.BAD_CHANNELS)
     displayResults(results, allMin, allMax)
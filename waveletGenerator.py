@@ -6,47 +6,31 @@ Given an edf input, and a set of bad channels,
 """
 
 import matplotlib.pyplot as plt
-import mne.io
 import numpy as np
 from tqdm import tqdm
 
-import collections
+import argparse
 import functools
-
+import multiprocessing
+import os
+
+import decimate
+import loader
+import memo
+import pairScheduler
+import profiler
+import slidingSync
+import synchro
 import viz
 
-class memoized(object):
-    '''Decorator. Caches a function's return value each time it is called.
-    If called later with the same arguments, the cached value is returned
-    (not reevaluated).
-    '''
-    def __init__(self, func):
-        self.func = func
-        self.cache = {}
-    def __call__(self, *args):
-        if not isinstance(args, collections.Hashable):
-            # uncacheable. a list, for instance.
-            # better to not cache than blow up.
-            return self.func(*args)
-        if args in self.cache:
-            return self.cache[args]
-        else:
-            value = self.func(*args)
-            self.cache[args] = value
-            return value
-    def __repr__(self):
-        '''Return the function's docstring.'''
-        return self.func.__doc__
-    def __get__(self, obj, objtype):
-        '''Support instance methods.'''
-        return functools.partial(self.__call__, obj)
+from memo import memoized
 
 START_TIME_SEC = 1
 END_TIME_SEC = 4.5 * 60
 
 # Dimension of points to use (i.e. sliding window size)
 PARAM_d = 10
-# Skip length in taking the last PARAM_d points
+# Skip length in taking the last PARAM_d points, in samples at the recording's full rate
 PARAM_T = 1
 # Probability cutoff
 P_REF = 0.05
@@ -54,10 +38,14 @@ P_REF = 0.05
 W1 = (PARAM_d - 1) * PARAM_T
 # Windows further to reference than this are ignored. Set later.
 W2 = None
+# Skip length actually used, at the signal's (possibly decimated) rate. Set later.
+T = PARAM_T
 
-# Downsampling for when calculating the average synchronicity
-Q = 100
+# Downsampling for when calculating the average synchronicity, in samples at the recording's full rate
+PARAM_Q = 100
 print("\n***Debug: Wrong Q! Should be set to 4\n")
+# Downsampling actually used, at the signal's (possibly decimated) rate. Set later.
+Q = PARAM_Q
 
 # Channels to include in the analysis:
 #          Fp1        F3        F7       FpZ       Fz      Fp2       F4        F8
@@ -65,8 +53,26 @@ print("\n***Debug: Wrong Q! Should be set to 4\n")
 PICKS = None # all non-bad channels.
 # Although EEG 8 is technically AFz, but is the closest to FpZ
 
+# Rate to decimate recordings to before analysis (e.g. decimate.TARGET_RATE), None for their full rate.
+# The skip length and windows are adjusted to match, see trialParams.
+DECIMATE_TO_HZ = None
+
+# Worker processes for calculating all channel pairs. None = all cores, 1 = no pool.
+N_PROCESSES = None
+
+# Whether to also write results as CSV, alongside the .npz
+SAVE_CSV = False
+
+# If set, also write BSL over time, in windows of this many seconds sliding by Q samples
+# (see slidingSync.py), from the same neighbourhoods as the whole-trial BSL.
+SLIDING_WINDOW_SEC = None
+
 # Global signal, (k channels x n samples)
 SIGNAL = None
+# Delay-embedded SIGNAL, (k channels x n vectors x PARAM_d), see synchro.embed. Set in process.
+EMBEDDED = None
+# Offsets m - n of the points compared against each reference n. Set in process.
+OFFSETS = None
 
 
 # Euclidean distance between two vectors
@@ -76,87 +82,117 @@ def dist(X1, X2):
 # X vector from paper
 # @memoize
 def X(k, n):
-    return SIGNAL[k, n : n + PARAM_d * PARAM_T : PARAM_T]
+    return SIGNAL[k, n : n + PARAM_d * T : T]
+
+# Current parameters, as passed to synchro / pairScheduler
+def syncParams():
+    return synchro.SyncParams(PARAM_d, T, W1, W2, P_REF, Q)
+
+# Parameters for a signal at sRate, decimated from fullRate if given. The skip length and the
+# spacing of reference points keep their lengths in seconds at the full rate, as near as whole
+# samples (at least 1) allow, W1 stays the span of an embedded vector, and W2 half a second.
+def trialParams(sRate, fullRate=None):
+    scaled = lambda n: n if fullRate is None else decimate.scaledLength(n, sRate, fullRate)
+    skip = scaled(PARAM_T)
+    return synchro.SyncParams(PARAM_d, skip, (PARAM_d - 1) * skip, int(sRate // 2), P_REF, scaled(PARAM_Q))
+
+# Normalization used by S and BS: 1 / (2 P_ref (W2 - W1))
+def syncScale():
+    return synchro.syncScale(syncParams())
+
+# All reference points n used for the averages SL and BSL
+def referencePoints():
+    return synchro.referencePoints(SIGNAL.shape[1], EMBEDDED.shape[1], W2, Q)
+
+# dist(X_k,m, X_k,n) for all m in the window around n, for every channel (k x m)
+def windowDists(n):
+    return synchro.windowDistances(EMBEDDED, n, OFFSETS)
+
+# As above, but just for the one channel k
+def channelDists(k, n):
+    return synchro.windowDistances(EMBEDDED[k:k+1], n, OFFSETS)[0]
 
 # Probability that dist(X_k,m, X_k,n) < ekn for given X_k,n
 # @memoize
 def PeknKN(ekn, k, n):
-    closeCount = 0
-    Xkn = X(k, n)
-    for m in range(n - W1, n - W2, -1):
-        if dist(X(k, m), Xkn) < ekn:
-            closeCount += 1
-    for m in range(n + W1, n + W2):
-        if dist(X(k, m), Xkn) < ekn:
-            closeCount += 1
+    closeCount = np.count_nonzero(channelDists(k, n) < ekn)
     return (1. / (2. * (W2 - W1))) * closeCount
 
-# Return the largest E_k,n such that P(dist(X_k,m, X_k,n) < ekn) < P_REF
-@memoized
-def E(k, n):
-    delta = 1e-6
+# Original incremental search for E_k,n, to within delta. Slow: rescans the window each step.
+# Kept as the reference definition, see checkEkns.
+def searchE(k, n, delta=1e-6):
     ekn = 0
     while PeknKN(ekn, k, n) < P_REF:
         ekn += delta
     return ekn - delta
 
+# Return the largest E_k,n such that P(dist(X_k,m, X_k,n) < ekn) < P_REF
+# Cached in a dense (channels x vectors) array, as it is needed for most n.
+@memo.denseMemoized(lambda: EMBEDDED.shape[:2])
+def E(k, n):
+    return synchro.epsilons(channelDists(k, n), P_REF)
+
+# E_k,n for all channels k, given the window distances around n if already known.
+def Ekns(n, dists=None):
+    ekns = E.column(n)
+    if ekns is None:
+        if dists is None:
+            dists = windowDists(n)
+        ekns = synchro.epsilons(dists, P_REF)
+        E.storeColumn(n, ekns)
+    return ekns
+
+# Close mask for all channels & window points around n, see synchro.closeMask
+def closeMask(n):
+    dists = windowDists(n)
+    return synchro.closeMask(dists, Ekns(n, dists))
+
+# Which window points around n are within E_k,n, for every channel, as bitsets (k x words).
+# Found once per n, then shared by every H and BS around it, see synchro.neighbourBits
+@memoized
+def neighbours(n):
+    dists = windowDists(n)
+    return synchro.neighbourBits(dists, Ekns(n, dists))
+
+# Index of offset m - n into OFFSETS (and the neighbour bitsets), None if outside the window.
+def windowIndex(offset):
+    if not W1 <= abs(offset) < W2:
+        return None
+    return -offset - W1 if offset < 0 else (W2 - W1) + offset - W1
+
 # Hn,m = # channels where dist(X_k,m, X_k,n) < ekn for that channel
 @memoized
 def H(n, m):
-    closeCount = 0
-    for k in range(SIGNAL.shape[0]):
-        if dist(X(k, n), X(k, m)) < E(k, n):
-            closeCount += 1
-    return closeCount
+    at = windowIndex(m - n)
+    if at is not None:
+        return np.count_nonzero(synchro.hasNeighbour(neighbours(n), at))
+    diffs = EMBEDDED[:, m, :] - EMBEDDED[:, n, :]
+    return np.count_nonzero(np.sqrt(np.einsum('kd,kd->k', diffs, diffs)) < Ekns(n))
 
 # Skn = Syncrhonization likelihood for each channel
 @memoized
 def S(k, n):
-    M = SIGNAL.shape[0]
-    Xkn, Ekn = X(k, n), E(k, n)
-
-    closeWeight = 0.
-    for m in range(n - W1, n - W2, -1):
-        if dist(X(k, m), Xkn) < Ekn:
-            closeWeight += (H(n, m) - 1.) / (M - 1.)
-    for m in range(n + W1, n + W2):
-        if dist(X(k, m), Xkn) < Ekn:
-            closeWeight += (H(n, m) - 1.) / (M - 1.)
-    return (1. / (2. * P_REF * (W2 - W1))) * closeWeight
+    return synchro.channelSynchronization(closeMask(n), syncScale())[k]
 
 # SLk = Average Syncrhonization likelihood for channel k
 @memoized
 def SL(k):
-    n0 = W2
-    N = len(SIGNAL[k])
     allSL = []
-    for n in tqdm(range(n0, N - W2 - 1, Q)):
+    for n in tqdm(referencePoints()):
         allSL.append(S(k, n))
     return np.mean(allSL)
 
 # BS_k,r,n = Bivariate Synchronicity between channels k & r, at time n
 @memoized
 def BS(k, r, n):
-    M = SIGNAL.shape[0]
-    Xkn, Ekn = X(k, n), E(k, n)
-    Xrn, Ern = X(r, n), E(r, n)
-
-    closePairCount = 0.
-    for m in range(n - W1, n - W2, -1):
-        if dist(X(k, m), Xkn) < Ekn and dist(X(r, m), Xrn) < Ern:
-            closePairCount += 1
-    for m in range(n + W1, n + W2):
-        if dist(X(k, m), Xkn) < Ekn and dist(X(r, m), Xrn) < Ern:
-            closePairCount += 1
-    return (1. / (2. * P_REF * (W2 - W1))) * closePairCount
+    bits = neighbours(n)
+    return syncScale() * synchro.popcount(bits[k] & bits[r]).sum()
 
 # BS_k,r = Average Bivariate Synchronicity between channels k & r
 @memoized
 def BSL(k, r):
-    n0 = W2
-    N = len(SIGNAL[k])
     allSL = []
-    for n in tqdm(range(n0, N - W2 - 1, Q)):
+    for n in tqdm(referencePoints()):
         allSL.append(BS(k, r, n))
     return np.mean(allSL)
 
@@ -173,6 +209,24 @@ def plotEkns(k):
     plt.plot(ekns)
     plt.show()
 
+# Regression check of E against the original incremental search, on synthetic signals: random
+# walks from a fixed seed, at a few sample rates (so window sizes, and closeCountNeeded, vary).
+# Amplitudes are small so distances are ~1e-3, keeping searchE to thousands of steps.
+# Asserts they agree to within delta at every reference point, for every channel.
+def checkEkns(seed=0, sRates=(100, 128, 250), nChannels=3, seconds=8, amplitude=1e-4, delta=1e-6):
+    rng = np.random.default_rng(seed)
+    worst = 0.
+    for sRate in sRates:
+        signal = amplitude * np.cumsum(rng.standard_normal((nChannels, int(seconds * sRate))), axis=1)
+        useTrial(Trial(signal, sRate, 'synthetic'))
+        for n in tqdm(referencePoints(), desc='%dhz' % sRate):
+            for k in range(nChannels):
+                difference = abs(E(k, n) - searchE(k, n, delta))
+                assert difference <= delta, "E(%d, %d) = %g, searchE = %g at %dhz" % (
+                    k, n, E(k, n), searchE(k, n, delta), sRate)
+                worst = max(worst, difference)
+    print("Max |E - searchE| = %g (delta = %g)" % (worst, delta))
+
 # Show Skns for all n for a given channel k
 def plotSkns(k):
     N = SIGNAL.shape[1]
@@ -196,49 +250,218 @@ def plotSLks():
     plt.plot(slks)
     plt.show()
 
-# Pairwise covariance matrix of Bivariate Synchronicity for all channels:
-def plotBSLs(longName):
-    M = SIGNAL.shape[0]
-    bsls = np.zeros((M, M))
+# Where the synchronization matrix for a trial gets written, see synchro.saveMatrix
+def outputFile(longName):
+    return "output/synchro/%s_q=%d.npz" % (viz.shortName(longName), PARAM_Q)
+
+# Where the optional CSV copy of the synchronization matrix gets written
+def csvFile(longName):
+    return "output/synchro/%s_q=%d.csv" % (viz.shortName(longName), PARAM_Q)
+
+# Where the (channels x channels x time) sliding window BSLs get written, as a .npy
+def slidingFile(longName):
+    return "output/synchro/%s_q=%d_sliding.npy" % (viz.shortName(longName), PARAM_Q)
+
+# Where the time, in seconds, of the middle of each sliding window gets written
+def slidingTimesFile(longName):
+    return "output/synchro/%s_q=%d_sliding_times.npy" % (viz.shortName(longName), PARAM_Q)
+
+# Directory where partial results for a trial are kept while it's being processed
+def checkpointFile(longName):
+    return "output/synchro/checkpoints/%s_q=%d/" % (viz.shortName(longName), PARAM_Q)
+
+# Sample rate and parameters a trial would be analysed with now, given DECIMATE_TO_HZ.
+def currentTrialParams(path):
+    fullRate = loader.openRaw(path, [], verbose=False).info['sfreq']
+    sRate = decimate.effectiveRate(fullRate, DECIMATE_TO_HZ)
+    return sRate, trialParams(sRate, fullRate)
+
+# Whether a trial's outputs (including sliding ones, if on) exist, are newer than its source edf,
+# and were calculated at the current rate and with the current parameters.
+def isUpToDate(path):
+    outputs = [outputFile(path)]
+    if SLIDING_WINDOW_SEC is not None:
+        outputs += [slidingFile(path), slidingTimesFile(path)]
+    edfTime = os.path.getmtime("data/" + path)
+    if not all(os.path.exists(output) and os.path.getmtime(output) >= edfTime for output in outputs):
+        return False
+    try:
+        _, _, savedParams, savedRate = synchro.loadMatrix(outputFile(path))
+    except KeyError: # Saved without its parameters.
+        return False
+    sRate, params = currentTrialParams(path)
+    return np.isclose(savedRate, sRate) and savedParams == params
+
+
+class Trial(object):
+    '''
+    A single trial's signal (with its channel names) and synchronization parameters.
+    Everything needed to process it lives here rather than in the module globals,
+    so multiple trials can be processed in the same interpreter, or at once.
+    If the signal was decimated, fullRate is the recording's rate, and sRate the decimated one.
+    '''
+    def __init__(self, signal, sRate, longName, channels=None, fullRate=None):
+        self.signal = signal
+        self.sRate = sRate
+        self.longName = longName
+        self.channels = channels if channels is not None else ['%d' % k for k in range(signal.shape[0])]
+        self.params = trialParams(sRate, fullRate)
+
+    def calculateBSLs(self, nProcesses=None):
+        """
+        BSL for all channel pairs, resuming from (and saving to) the trial's checkpoint.
+        """
+        checkpoint = pairScheduler.Checkpoint(checkpointFile(self.longName), self.signal, self.params)
+        bsls = pairScheduler.parallelBSLs(self.signal, self.params, nProcesses or N_PROCESSES, checkpoint)
+        checkpoint.remove()
+        return bsls
+
+    def calculateSlidingBSLs(self, windowSec, nProcesses=None):
+        """
+        BSL for all channel pairs over time, in windows of windowSec sliding by Q samples,
+        memory-mapped to the trial's slidingFile. Returns (BSLs over time, window middle
+        times in seconds, BSL over the whole trial).
+        Neighbourhoods and the whole trial's BSL are found as in calculateBSLs, in parallel and
+        resuming from the checkpoint, which is kept until the sliding totals are written too.
+        Those totals are a single process's pass over the checkpoint's neighbour bitsets:
+        if interrupted, that pass (only) starts again.
+        """
+        checkpoint = pairScheduler.Checkpoint(checkpointFile(self.longName), self.signal, self.params)
+        bsls = pairScheduler.parallelBSLs(self.signal, self.params, nProcesses or N_PROCESSES, checkpoint)
+        M, N = self.signal.shape
+        refs = synchro.referencePoints(N, N - (self.params.d - 1) * self.params.T, self.params.W2, self.params.Q)
+        windowRefs = min(max(int(round(windowSec * self.sRate / self.params.Q)), 1), len(refs))
+        path = slidingFile(self.longName)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        out = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(M, M, len(refs) - windowRefs + 1))
+        with profiler.span('sliding'):
+            slidingSync.slidingFromNeighbours(checkpoint.neighbours, windowRefs, synchro.syncScale(self.params), out)
+        times = START_TIME_SEC + slidingSync.windowCentres(refs, windowRefs) / self.sRate
+        with profiler.span('save'):
+            out.flush()
+            np.save(slidingTimesFile(self.longName), times)
+        checkpoint.remove()
+        return out, times, bsls
+
+    def calculateAll(self, nProcesses=None):
+        """
+        BSL for all channel pairs, and over time too if SLIDING_WINDOW_SEC is set.
+        """
+        if SLIDING_WINDOW_SEC is None:
+            return self.calculateBSLs(nProcesses)
+        _, _, bsls = self.calculateSlidingBSLs(SLIDING_WINDOW_SEC, nProcesses)
+        return bsls
+
+    def save(self, bsls):
+        print("Saving to %s..." % outputFile(self.longName))
+        with profiler.span('save'):
+            synchro.saveMatrix(outputFile(self.longName), bsls, self.channels, self.params, self.sRate)
+            if SAVE_CSV:
+                np.savetxt(csvFile(self.longName), bsls, delimiter=', ', fmt='%.8f')
 
-    allK, allR = np.meshgrid(range(M), range(M))
-    allK, allR = allK.ravel(), allR.ravel()
-    for k, r in zip(tqdm(allK), allR):
-        bsls[k, r] = BSL(k, r)
-    print(bsls)
 
-    shortName = viz.shortName(longName)
-    outputFile = "output/synchro/%s_q=%d.csv" % (shortName, Q)
-    print("Saving to %s..." % outputFile)
-    np.savetxt(outputFile, bsls, delimiter=', ', fmt='%.8f')
+# Pairwise covariance matrix of Bivariate Synchronicity for all channels:
+def plotBSLs(trial):
+    with profiler.span('BSLs'):
+        bsls = trial.calculateAll()
+    print(bsls)
+    trial.save(bsls)
+    with profiler.span('plot'):
+        viz.correlationMatrix(bsls)
 
-    viz.correlationMatrix(bsls)
 
+# Set the module globals (SIGNAL, windows etc.) that E, H, S, BS... work on to a trial's.
+def useTrial(trial):
+    global SIGNAL, EMBEDDED, OFFSETS, T, W1, W2, Q
+    memo.clearAll() # Cached values are only valid for the previous signal.
+    SIGNAL = trial.signal
+    T, W1, W2, Q = trial.params.T, trial.params.W1, trial.params.W2, trial.params.Q
+    EMBEDDED = synchro.embed(SIGNAL, PARAM_d, T)
+    OFFSETS = synchro.windowOffsets(W1, W2)
 
 # Still in progress...don't run yet...
-def process(signal, sRate, longName):
-    global SIGNAL, W2
-    SIGNAL = signal
-    W2 = int(sRate // 2)
-    plotBSLs(longName)
+def process(trial):
+    with profiler.trial(trial.longName, sRate=trial.sRate, params=trial.params._asdict(), shape=trial.signal.shape):
+        useTrial(trial)
+        plotBSLs(trial)
+
+
+# Load the picked channels of a trial, between the start and end times.
+# Returns (data, channel names, sample rate)
+def loadSignal(path, bads):
+    return loader.loadTrial(path, bads, PICKS, START_TIME_SEC, END_TIME_SEC)
+
+# Load a trial (see loadSignal), decimated to DECIMATE_TO_HZ if set.
+def loadTrial(path, bads):
+    with profiler.span('load'):
+        data, channels, fullRate = loadSignal(path, bads)
+    with profiler.span('decimate'):
+        data, sRate = decimate.resample(data, fullRate, DECIMATE_TO_HZ)
+    return Trial(data, sRate, path, channels, fullRate)
+
+# Calculate and save the synchronization matrix for [path, badChannels], without plotting.
+def processOne(pathAndBads, nProcesses=None):
+    path, bads = pathAndBads
+    with profiler.trial(path):
+        trial = loadTrial(path, bads)
+        profiler.note(sRate=trial.sRate, params=trial.params._asdict(), shape=trial.signal.shape)
+        with profiler.span('BSLs'):
+            bsls = trial.calculateAll(nProcesses)
+        trial.save(bsls)
+    return path
+
+def processAll(badMapping, nTrials=1, nProcesses=None, force=False):
+    """
+    Given a mapping path -> list of bad channels for that data, calculate and save the
+    synchronization matrices for all trials, skipping those already up to date unless forced.
+    Runs nTrials trials at once; if more than one, each trial's pairs run in its own process only.
+    """
+    todo = []
+    for path, bads in sorted(badMapping.items()):
+        if not os.path.exists(loader.DATA_DIR + path):
+            print("Skipping %s, not found in %s" % (path, loader.DATA_DIR))
+        elif not force and isUpToDate(path):
+            print("Skipping %s, %s is up to date" % (path, outputFile(path)))
+        else:
+            todo.append([path, bads])
 
+    if nTrials == 1:
+        for pathAndBads in todo:
+            processOne(pathAndBads, nProcesses)
+    else:
+        with multiprocessing.Pool(processes=nTrials) as pool:
+            for path in pool.imap_unordered(functools.partial(processOne, nProcesses=1), todo):
+                print("Finished %s" % path)
 
 
 def main():
     # path = 'T013_D001_V00_2017_05_16_Emily-Resting-30Hzfilt.edf'
     path = 'T013_D010_V00_2017_05_15_Yana-Focus-30Hzfilt.edf'
-    bads = ['STI 014', 'EEG 18', 'EEG 56', 'EEG VREF']
-    raw = mne.io.read_raw_edf("data/" + path, preload=True)
-    raw = raw.crop(tmin=START_TIME_SEC, tmax=END_TIME_SEC)
-    raw.info['bads'] = bads
-
-    pickIDs = mne.pick_types(raw.info, eeg=True, selection=PICKS)
-    data = np.take(raw._data, pickIDs, axis=0)
-    print(data.shape)
-
-    sRate = raw.info['sfreq']
-    process(data, sRate, path)
-
-
-
-if __name__ == '__main__': main()
+    bads = loader.BAD_CHANNELS[path]
+    with profiler.trial(path):
+        trial = loadTrial(path, bads)
+        print("%s at %.1fhz" % (trial.signal.shape, trial.sRate))
+        process(trial)
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--check', action='store_true',
+                        help="Check E against the original search on synthetic signals, instead of processing a trial")
+    parser.add_argument('--all', action='store_true',
+                        help="Calculate and save the matrices of every trial in loader.BAD_CHANNELS, without plotting")
+    parser.add_argument('--trials', type=int, default=1,
+                        help="With --all, trials to run at once")
+    parser.add_argument('--processes', type=int, default=N_PROCESSES,
+                        help="With --all, worker processes per trial (default: all cores)")
+    parser.add_argument('--force', action='store_true',
+                        help="With --all, recalculate trials even if their output is up to date")
+    args = parser.parse_args()
+    if args.check:
+        checkEkns()
+    elif args.all:
+        processAll(loader.BAD_CHANNELS, args.trials, args.processes, args.force)
+    else:
+        main()